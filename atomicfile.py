@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+import os
+from contextlib import contextmanager
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+# Write a file through a buffered temp file next to it that is fsync'd and
+# renamed over the target on success, so readers never see a half written file
+# and a failed run or a crash leaves the previous one in place. The temp name
+# carries the pid so processes sharing a directory never write the same one.
+@contextmanager
+def AtomicFile(path, mode="w"):
+  directory = os.path.dirname(path)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  tmp_path = path + "." + str(os.getpid()) + ".tmp"
+  try:
+    with open(tmp_path, mode, buffering=WRITE_BUFFER_SIZE) as f:
+      yield f
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import shutil
+import hashlib
+import threading
+import tarfile
+import urllib.error
+import urllib.request
+import atomicfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Turn a digest (sha256:abc...) into something safe to use as a file name
+def DigestKey(digest):
+  return re.sub(r'[^A-Za-z0-9_.-]', '-', digest)
+
+
+# Total size in bytes of a file or directory tree
+def PathSize(path):
+  if os.path.isfile(path):
+    return os.path.getsize(path)
+  total = 0
+  for root, dirs, files in os.walk(path):
+    for name in files:
+      total += os.path.getsize(os.path.join(root, name))
+  return total
+
+
+def RemovePath(path):
+  if os.path.isdir(path):
+    shutil.rmtree(path, ignore_errors=True)
+  elif os.path.exists(path):
+    os.remove(path)
+
+
+# Least recently used eviction over the entries of a cache directory. Entry
+# access time is tracked with the mtime so it survives between runs.
+def EvictLeastRecentlyUsed(directory, max_bytes=0, max_entries=0, keep=None):
+  if not os.path.isdir(directory):
+    return
+  entries = []
+  for name in os.listdir(directory):
+    path = os.path.join(directory, name)
+    if name.endswith(".tmp"):
+      continue
+    entries.append([os.path.getmtime(path), PathSize(path), path])
+  entries.sort()
+  total = sum(entry[1] for entry in entries)
+  count = len(entries)
+  for mtime, size, path in entries:
+    over_size = max_bytes > 0 and total > max_bytes
+    over_count = max_entries > 0 and count > max_entries
+    if not over_size and not over_count:
+      break
+    if path == keep:
+      continue
+    print("Evicting cache entry " + path)
+    RemovePath(path)
+    total -= size
+    count -= 1
+
+
+# Rendered catalog indexes keyed by the digest of the index image
+class RenderCache:
+  # Digest -> lock, so catalogs pruned in parallel from the same index render it only once
+  locks = {}
+  locks_lock = threading.Lock()
+
+  def __init__(self, directory, max_bytes=0, max_entries=0):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.max_entries = max_entries
+    os.makedirs(self.directory, exist_ok=True)
+
+  def Path(self, digest):
+    return os.path.join(self.directory, DigestKey(digest) + ".json")
+
+  # Returns the path of the cached render or None
+  def Get(self, digest):
+    path = self.Path(digest)
+    if not os.path.exists(path):
+      return None
+    os.utime(path)
+    return path
+
+  # Cached render of digest, rendering it first if needed. Returns (path, was cached)
+  def Fetch(self, digest, render):
+    with RenderCache.locks_lock:
+      lock = RenderCache.locks.setdefault(digest, threading.Lock())
+    with lock:
+      cached = self.Get(digest)
+      if cached is not None:
+        return cached, True
+      return self.Put(digest, render), False
+
+  # render is called with a file object to write the rendered catalog to
+  def Put(self, digest, render):
+    path = self.Path(digest)
+    with atomicfile.AtomicFile(path) as f:
+      render(f)
+    EvictLeastRecentlyUsed(self.directory, self.max_bytes, self.max_entries, keep=path)
+    return path
+
+
+# Content addressable cache of image layers and configs shared by every image
+# copy. An image is first pulled into its own OCI layout whose blobs live in the
+# shared blob directory, where skopeo reuses any blob already present instead of
+# fetching it from upstream again, and is then pushed from that layout to the
+# destination. Blob use is tracked in memory in least recently used order, and
+# with the mtime so the order survives between runs. The size bound is enforced
+# after every pull; blobs of images still being pushed are pinned until Release.
+class BlobCache:
+  MANIFEST_MEDIA_TYPES = (
+      "application/vnd.oci.image.index.v1+json",
+      "application/vnd.oci.image.manifest.v1+json",
+      "application/vnd.docker.distribution.manifest.list.v2+json",
+      "application/vnd.docker.distribution.manifest.v2+json")
+
+  def __init__(self, directory, max_bytes=0):
+    self.directory = directory
+    self.blob_dir = os.path.join(directory, "blobs")
+    self.layout_dir = os.path.join(directory, "layouts")
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.changed = threading.Condition(self.lock)
+    self.pulls = 0
+    self.evicting = False
+    os.makedirs(self.blob_dir, exist_ok=True)
+    os.makedirs(self.layout_dir, exist_ok=True)
+    blobs = []
+    for algorithm in os.listdir(self.blob_dir):
+      for encoded in os.listdir(os.path.join(self.blob_dir, algorithm)):
+        stat = os.stat(os.path.join(self.blob_dir, algorithm, encoded))
+        blobs.append((stat.st_mtime, algorithm + ":" + encoded, stat.st_size))
+    # {digest: size}, least recently used first
+    self.known = OrderedDict((digest, size) for _, digest, size in sorted(blobs))
+    self.total = sum(self.known.values())
+    self.pins = {}
+    self.pinned_layouts = {}
+
+  def BlobPath(self, digest):
+    algorithm, encoded = digest.split(":", 1)
+    return os.path.join(self.blob_dir, algorithm, encoded)
+
+  # Working layout of one image, only holds its index.json
+  def LayoutPath(self, image):
+    return os.path.join(self.layout_dir, DigestKey(image))
+
+  # Digests of every blob a layout references, following image indexes of multi arch images
+  def LayoutBlobs(self, layout_path):
+    with open(os.path.join(layout_path, "index.json")) as f:
+      descriptors = list(json.load(f).get("manifests", []))
+    digests = set()
+    while descriptors:
+      descriptor = descriptors.pop()
+      digest = descriptor["digest"]
+      if digest in digests:
+        continue
+      digests.add(digest)
+      if descriptor.get("mediaType") in BlobCache.MANIFEST_MEDIA_TYPES:
+        with open(self.BlobPath(digest)) as f:
+          manifest = json.load(f)
+        descriptors.extend(manifest.get("manifests", []))
+        descriptors.extend(manifest.get("layers", []))
+        if "config" in manifest:
+          descriptors.append(manifest["config"])
+    return digests
+
+  # A pull into the shared blob dir may reuse blobs it found there without
+  # them being pinned yet, so eviction waits for pulls in flight to finish and
+  # new pulls wait for an eviction. Call Used inside to pin what was pulled.
+  @contextmanager
+  def Pulling(self):
+    with self.changed:
+      while self.evicting:
+        self.changed.wait()
+      self.pulls += 1
+    try:
+      yield
+    finally:
+      with self.changed:
+        self.pulls -= 1
+        self.changed.notify_all()
+
+  # Mark the blobs of a finished pull as used and pin them until Release. Blobs
+  # the cache already knew were served from it, the rest were fetched.
+  # Returns (cached bytes, fetched bytes)
+  def Used(self, layout_path):
+    cached = 0
+    fetched = 0
+    digests = []
+    for digest in self.LayoutBlobs(layout_path):
+      path = self.BlobPath(digest)
+      if not os.path.exists(path):
+        continue
+      size = os.path.getsize(path)
+      with self.lock:
+        hit = digest in self.known
+        if hit:
+          self.known.move_to_end(digest)
+        else:
+          self.known[digest] = size
+          self.total += size
+        self.pins[digest] = self.pins.get(digest, 0) + 1
+      digests.append(digest)
+      if hit:
+        cached += size
+        os.utime(path)
+      else:
+        fetched += size
+    with self.lock:
+      self.pinned_layouts[layout_path] = digests
+    return cached, fetched
+
+  def Release(self, layout_path):
+    with self.lock:
+      for digest in self.pinned_layouts.pop(layout_path, []):
+        self.pins[digest] -= 1
+        if self.pins[digest] == 0:
+          del self.pins[digest]
+    RemovePath(layout_path)
+
+  def Size(self):
+    return PathSize(self.blob_dir)
+
+  # Drop least recently used blobs until the cache fits max_bytes, never one
+  # that an image still being copied through the cache uses
+  def Evict(self):
+    if self.max_bytes <= 0:
+      return
+    victims = []
+    with self.changed:
+      if self.evicting or self.total <= self.max_bytes:
+        return
+      self.evicting = True
+      while self.pulls:
+        self.changed.wait()
+      excess = self.total - self.max_bytes
+      for digest, size in self.known.items():
+        if excess <= 0:
+          break
+        if digest not in self.pins:
+          victims.append(digest)
+          excess -= size
+      for digest in victims:
+        self.total -= self.known.pop(digest)
+    try:
+      for digest in victims:
+        RemovePath(self.BlobPath(digest))
+    finally:
+      with self.changed:
+        self.evicting = False
+        self.changed.notify_all()
+
+
+# sha256 of a file, read in chunks so large archives don't land in memory
+def FileSha256(path):
+  digest = hashlib.sha256()
+  with open(path, "rb") as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+# Parse a sha256sum.txt style listing into {file name: checksum}
+def ParseChecksumList(content):
+  checksums = {}
+  for line in content.splitlines():
+    fields = line.split()
+    if len(fields) == 2:
+      checksums[fields[1].lstrip("*")] = fields[0]
+  return checksums
+
+
+# Client tool archives (opm, oc) downloaded from the OpenShift mirror, extracted
+# once per channel and OCP version and verified against the published checksums
+class ToolCache:
+  def __init__(self, directory, base_url, offline=False):
+    self.directory = directory
+    self.base_url = base_url if base_url.endswith("/") else base_url + "/"
+    self.offline = offline
+
+  def GetTool(self, channel, ocp_version, archive_name, binary_name):
+    release = channel + "-" + ocp_version
+    tool_dir = os.path.join(self.directory, release, archive_name.split(".")[0])
+    binary_path = os.path.join(tool_dir, binary_name)
+    checksum_path = os.path.join(tool_dir, archive_name + ".sha256")
+    cached_checksum = None
+    if os.path.exists(binary_path) and os.path.exists(checksum_path):
+      with open(checksum_path) as f:
+        cached_checksum = f.read().strip()
+
+    if self.offline:
+      if cached_checksum is None:
+        raise RuntimeError("Offline mode and no cached " + binary_name + " for " + release + " in " + self.directory)
+      print("Using cached " + binary_name + " from " + tool_dir)
+      return binary_path
+
+    release_url = self.base_url + release + "/"
+    expected_checksum = self.GetPublishedChecksum(release_url, archive_name)
+    if cached_checksum is not None and (expected_checksum is None or expected_checksum == cached_checksum):
+      print("Using cached " + binary_name + " from " + tool_dir)
+      return binary_path
+
+    os.makedirs(self.directory, exist_ok=True)
+    archive_file_path = os.path.join(self.directory, release + "-" + archive_name + ".tmp")
+    print(release_url + archive_name)
+    print("Downloading " + binary_name + " Cli...")
+    try:
+      urllib.request.urlretrieve(release_url + archive_name, archive_file_path)
+      checksum = FileSha256(archive_file_path)
+      if expected_checksum is not None and checksum != expected_checksum:
+        raise RuntimeError("Checksum mismatch for " + archive_name + ": expected " + expected_checksum + " got " + checksum)
+
+      print("Extracting " + binary_name + " Cli...")
+      RemovePath(tool_dir)
+      os.makedirs(tool_dir)
+      with tarfile.open(archive_file_path) as tf:
+        tf.extractall(tool_dir)
+      # Written last, a binary without a checksum file is treated as a partial extract
+      with open(checksum_path, "w") as f:
+        f.write(checksum + "\n")
+    finally:
+      RemovePath(archive_file_path)
+    return binary_path
+
+  # Checksum published for an archive, None if the listing can not be fetched
+  def GetPublishedChecksum(self, release_url, archive_name):
+    try:
+      with urllib.request.urlopen(release_url + "sha256sum.txt") as response:
+        checksums = ParseChecksumList(response.read().decode("utf-8"))
+    except (urllib.error.URLError, OSError) as exc:
+      print("Unable to fetch checksums from " + release_url + ", skipping verification")
+      print(exc)
+      return None
+    return checksums.get(archive_name)
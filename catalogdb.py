@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+import os
+import sqlite3
+import urllib.parse
+
+# SQLite's default limit on host parameters in a single statement
+MAX_QUERY_PARAMETERS = 999
+
+
+# Read-only access to a legacy (OCP <= 4.10) sqlite index.db. The database is
+# opened once in immutable mode and every query is parameterized and exact match.
+class CatalogDb:
+  def __init__(self, db_path):
+    uri = "file:" + urllib.parse.quote(os.path.abspath(db_path)) + "?mode=ro&immutable=1"
+    self.con = sqlite3.connect(uri, uri=True)
+    self.default_channels = {}
+    self.CreateTempIndexes()
+
+  # index.db is read-only, so the lookups we do per bundle and per version go
+  # through indexed temp copies of the two tables that have no usable index
+  def CreateTempIndexes(self):
+    self.con.executescript("""
+      CREATE TEMP TABLE bundle AS
+        SELECT name, version, skiprange, replaces, bundlepath FROM main.operatorbundle;
+      CREATE INDEX temp.bundle_name ON bundle(name);
+      CREATE INDEX temp.bundle_version ON bundle(version);
+      CREATE TEMP TABLE bundle_related_image AS
+        SELECT operatorbundle_name, image FROM main.related_image;
+      CREATE INDEX temp.bundle_related_image_bundle ON bundle_related_image(operatorbundle_name);
+    """)
+
+  def Close(self):
+    self.con.close()
+
+  def GetDefaultChannel(self, package):
+    if package not in self.default_channels:
+      row = self.con.execute(
+          "SELECT default_channel FROM package WHERE name = ?", (package,)).fetchone()
+      self.default_channels[package] = row[0] if row else None
+    return self.default_channels[package]
+
+  def GetChannelHead(self, package, channel):
+    row = self.con.execute(
+        "SELECT head_operatorbundle_name FROM channel WHERE package_name = ? AND name = ?",
+        (package, channel)).fetchone()
+    return row[0] if row else None
+
+  # [name, skiprange, version, replaces] of every bundle in one channel of a package
+  def GetPackageBundles(self, package, channel):
+    return self.con.execute(
+        "SELECT DISTINCT b.name, b.skiprange, b.version, b.replaces FROM channel_entry e"
+        " JOIN bundle b ON b.name = e.operatorbundle_name"
+        " WHERE e.package_name = ? AND e.channel_name = ?",
+        (package, channel)).fetchall()
+
+  # Bundle name of a version in a channel, None if the channel has no such version
+  def GetChannelBundle(self, package, channel, version):
+    row = self.con.execute(
+        "SELECT e.operatorbundle_name FROM channel_entry e"
+        " JOIN bundle b ON b.name = e.operatorbundle_name"
+        " WHERE e.package_name = ? AND e.channel_name = ? AND b.version = ?",
+        (package, channel, version)).fetchone()
+    return row[0] if row else None
+
+  def GetBundleVersion(self, bundle_name):
+    row = self.con.execute(
+        "SELECT version FROM bundle WHERE name = ?", (bundle_name,)).fetchone()
+    return row[0] if row else None
+
+  def GetBundlePath(self, bundle_name):
+    row = self.con.execute(
+        "SELECT bundlepath FROM bundle WHERE name = ?", (bundle_name,)).fetchone()
+    return row[0] if row else None
+
+  # {bundle name: [related images]} for many bundles, one query per batch
+  def GetRelatedImages(self, bundle_names):
+    related = {name: [] for name in bundle_names}
+    bundle_names = list(related)
+    for i in range(0, len(bundle_names), MAX_QUERY_PARAMETERS):
+      batch = bundle_names[i:i + MAX_QUERY_PARAMETERS]
+      placeholders = ",".join("?" * len(batch))
+      rows = self.con.execute(
+          "SELECT operatorbundle_name, image FROM bundle_related_image"
+          " WHERE operatorbundle_name IN (" + placeholders + ")", batch)
+      for bundle_name, image in rows:
+        related[bundle_name].append(image)
+    return related
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+import json
+import atomicfile
+
+
+# Related images of a bundle as plain references, FBC bundles list them as
+# {"name", "image"} while the sqlite path stores bare strings
+def GetRelatedImageRefs(bundle):
+  refs = set()
+  for image in bundle.relatedImages:
+    refs.add(image["image"] if isinstance(image, dict) else image)
+  return refs
+
+
+# {bundle name: (package, version, bundle image, related images)} of the selected operators
+def GetBundleIndex(operators):
+  index = {}
+  for operator in operators:
+    for bundle in operator.operator_bundles:
+      index[bundle.name] = (operator.name, bundle.version, bundle.image, GetRelatedImageRefs(bundle))
+  return index
+
+
+# Compare what was selected from two versions of a catalog for the same operator
+# list. A bundle is changed when it exists in both but its bundle image or
+# related images differ, which happens when an index is rebuilt with respins.
+def DiffCatalogs(old_operators, new_operators):
+  old = GetBundleIndex(old_operators)
+  new = GetBundleIndex(new_operators)
+  old_images = set().union(*[entry[3] for entry in old.values()])
+  new_images = set().union(*[entry[3] for entry in new.values()])
+
+  def Bundle(name, entry):
+    return {"name": name, "package": entry[0], "version": entry[1]}
+
+  changed = []
+  for name in sorted(set(old) & set(new)):
+    if old[name][2] != new[name][2] or old[name][3] != new[name][3]:
+      change = Bundle(name, new[name])
+      change["added_images"] = sorted(new[name][3] - old[name][3])
+      change["removed_images"] = sorted(old[name][3] - new[name][3])
+      changed.append(change)
+  return {
+      "added_bundles": [Bundle(name, new[name]) for name in sorted(set(new) - set(old))],
+      "removed_bundles": [Bundle(name, old[name]) for name in sorted(set(old) - set(new))],
+      "changed_bundles": changed,
+      "added_images": sorted(new_images - old_images),
+      "removed_images": sorted(old_images - new_images)}
+
+
+def WriteDiff(path, baseline, current, diff):
+  with atomicfile.AtomicFile(path) as f:
+    json.dump(dict({"baseline": baseline, "current": current}, **diff), f, indent=2)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+import re
+import json
+import upgradepath
+from natsort import natsorted
+
+WHITESPACE = re.compile(r'\s*')
+
+
+# Stream objects out of a rendered file based catalog one at a time.
+# opm render emits a sequence of (pretty printed) JSON documents, so decode them
+# straight off a buffered stream instead of loading the whole index into memory.
+def ReadFileBasedCatalog(path, chunk_size=1024 * 1024):
+  decoder = json.JSONDecoder()
+  with open(path, encoding='utf-8') as f:
+    buf = ''
+    pos = 0
+    eof = False
+    while True:
+      pos = WHITESPACE.match(buf, pos).end()
+      if pos == len(buf):
+        if eof:
+          return
+        buf = f.read(chunk_size)
+        pos = 0
+        eof = buf == ''
+        continue
+      try:
+        obj, pos = decoder.raw_decode(buf, pos)
+      except json.JSONDecodeError:
+        if eof:
+          raise
+        # Object continues past the buffer, read at least as much again so
+        # large objects (base64 icons) are decoded in a logarithmic number of attempts
+        chunk = f.read(max(chunk_size, len(buf) - pos))
+        eof = chunk == ''
+        buf = buf[pos:] + chunk
+        pos = 0
+        continue
+      yield obj
+
+
+# Version from the olm.package property of a bundle, empty string if it is not set
+def GetBundleVersion(bundle):
+  for prop in bundle.get('properties') or []:
+    if prop.get('type') == 'olm.package':
+      return prop.get('value', {}).get('version', '')
+  return ''
+
+
+# Channel head, the natsorted highest entry name
+def GetChannelHead(channel):
+  head = natsorted([ent['name'] for ent in channel['entries']])[-1]
+  return next(ent for ent in channel['entries'] if ent['name'] == head)
+
+
+# Upgrade graph of a channel as version -> [versions it can upgrade to], from the
+# replaces, skips and skipRange of every entry. start_version is added as a node so
+# a start version with no bundle in the channel can still enter through a skipRange.
+def GetChannelUpgradeGraph(channel, versions, start_version):
+  nodes = set(versions.values())
+  nodes.add(start_version)
+  sorted_nodes = sorted(nodes, key=upgradepath.ParseVersion)
+  sorted_keys = [upgradepath.ParseVersion(v) for v in sorted_nodes]
+  graph = {}
+  seen = set()
+
+  def AddEdge(from_version, to_version):
+    if (from_version, to_version) not in seen:
+      seen.add((from_version, to_version))
+      graph.setdefault(from_version, []).append(to_version)
+
+  for ent in channel['entries']:
+    to_version = versions[ent['name']]
+    if ent.get('replaces') in versions:
+      AddEdge(versions[ent['replaces']], to_version)
+    for skipped in ent.get('skips') or []:
+      if skipped in versions:
+        AddEdge(versions[skipped], to_version)
+    if ent.get('skipRange'):
+      for lower, upper in upgradepath.GetSkipRangeSlices(ent['skipRange'], sorted_keys):
+        for from_version in sorted_nodes[lower:upper]:
+          if from_version != to_version:
+            AddEdge(from_version, to_version)
+  return graph
+
+
+# Shortest upgrade path through a channel from start_version to the channel head.
+# bundle_versions maps bundle name -> version for the bundles of the package.
+# Returns (start bundle name or None, [channel entries along the path]); the start
+# bundle itself is not part of the path as it is already installed.
+def GetChannelUpgradePath(operator, channel, bundle_versions, start_version):
+  versions = {}
+  for ent in channel['entries']:
+    versions[ent['name']] = bundle_versions.get(ent['name']) or upgradepath.GetVersion(ent['name'])
+  names = {upgradepath.ParseVersion(v): name for name, v in versions.items()}
+
+  head = GetChannelHead(channel)
+  start_name = names.get(upgradepath.ParseVersion(start_version))
+  if start_name == head['name']:
+    return None, [head]
+  start_node = versions[start_name] if start_name is not None else start_version
+
+  graph = GetChannelUpgradeGraph(channel, versions, start_node)
+  targets, parents = upgradepath.GetUpgradePathParents(operator, start_node, versions[head['name']], graph)
+  upgrade_path = upgradepath.GetUpgradePath(start_node, targets[0], parents)
+  entries = {ent['name']: ent for ent in channel['entries']}
+  return start_name, [entries[names[upgradepath.ParseVersion(v)]] for v in upgrade_path]
+
+
+# Rewrite the entries along an upgrade path into a self contained replaces chain,
+# keeping skipRanges and only the skips that still point at kept bundles
+def GetUpgradePathEntries(start_name, path_entries):
+  kept = set(ent['name'] for ent in path_entries)
+  if start_name is not None:
+    kept.add(start_name)
+  entries = []
+  previous = start_name
+  for ent in path_entries:
+    entry = {'name': ent['name']}
+    if previous is not None:
+      entry['replaces'] = previous
+    skips = [skipped for skipped in ent.get('skips') or [] if skipped in kept and skipped != previous]
+    if skips:
+      entry['skips'] = skips
+    if ent.get('skipRange'):
+      entry['skipRange'] = ent['skipRange']
+    entries.append(entry)
+    previous = ent['name']
+  return entries
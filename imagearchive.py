@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+import os
+import re
+import json
+import atomicfile
+from datetime import datetime, timezone
+
+# On disk layout of an air-gapped export:
+#
+#   <dir>/archive.json            what the archive holds, read by --from-dir
+#   <dir>/blobs/sha256/...        layers and configs of every image, stored once
+#   <dir>/images/<registry>/<repository>/<tag or digest>/
+#                                 one OCI layout per image, index.json only,
+#                                 its blobs live in the shared blob directory
+#   <dir>/catalogs/<name>/        OCI layout of each pruned catalog image
+ARCHIVE_INDEX = "archive.json"
+ARCHIVE_VERSION = 1
+
+
+def SharedBlobDir(archive_dir):
+  return os.path.join(archive_dir, "blobs")
+
+
+# Path of the OCI layout holding an image, relative to the archive directory.
+# skopeo splits oci:<path>:<reference> on ":", so the registry port is replaced
+def ImageLayoutPath(ref):
+  if ref.tag and ref.digest:
+    leaf = ref.tag + "-" + ref.digest.replace(":", "-")
+  elif ref.digest:
+    leaf = ref.digest.replace(":", "-")
+  else:
+    leaf = ref.tag or "latest"
+  return os.path.join("images", re.sub(r'[^A-Za-z0-9_.-]', '-', ref.registry), ref.repository, leaf)
+
+
+def CatalogLayoutPath(name):
+  return os.path.join("catalogs", name)
+
+
+# skopeo writes index.json when the copy commits, so a layout without one is an interrupted copy
+def IsLayoutComplete(archive_dir, layout_path):
+  return os.path.exists(os.path.join(archive_dir, layout_path, "index.json"))
+
+
+# catalogs: [{"name", "display_name", "image", "path"}] where image is the
+# catalog repository and tag without a registry, so it can be pushed anywhere
+def WriteArchiveIndex(archive_dir, images, catalogs):
+  index = {
+      "version": ARCHIVE_VERSION,
+      "created": datetime.now(timezone.utc).isoformat(),
+      "images": [{"source": str(ref), "path": ImageLayoutPath(ref)} for ref in images],
+      "catalogs": catalogs}
+  index_path = os.path.join(archive_dir, ARCHIVE_INDEX)
+  with atomicfile.AtomicFile(index_path) as f:
+    json.dump(index, f, indent=2)
+  return index_path
+
+
+def ReadArchiveIndex(archive_dir):
+  with open(os.path.join(archive_dir, ARCHIVE_INDEX)) as f:
+    index = json.load(f)
+  if index.get("version") != ARCHIVE_VERSION:
+    raise ValueError("Unsupported archive version " + str(index.get("version")))
+  return index
+
+
+# Size of the archive on disk, i.e. what has to be carried across the air gap
+def ArchiveSize(archive_dir):
+  total = 0
+  for root, _, files in os.walk(archive_dir):
+    for name in files:
+      total += os.path.getsize(os.path.join(root, name))
+  return total
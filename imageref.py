@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import re
+import fnmatch
+
+
+# Parsed image reference: registry/repository[:tag][@digest]
+# The registry is everything before the first "/", which is how the rest of the
+# tooling has always split source and destination urls.
+class ImageRef:
+  __slots__ = ("registry", "repository", "tag", "digest", "reference")
+
+  def __init__(self, registry, repository, tag="", digest=""):
+    self.registry = registry
+    self.repository = repository
+    self.tag = tag
+    self.digest = digest
+    reference = registry + "/" + repository if registry else repository
+    if tag:
+      reference += ":" + tag
+    if digest:
+      reference += "@" + digest
+    self.reference = reference
+
+  def __str__(self):
+    return self.reference
+
+  def __repr__(self):
+    return "ImageRef(" + repr(self.reference) + ")"
+
+  def __eq__(self, other):
+    if isinstance(other, ImageRef):
+      return self.reference == other.reference
+    return NotImplemented
+
+  def __hash__(self):
+    return hash(self.reference)
+
+  # registry/repository without tag or digest
+  def Name(self):
+    if self.registry:
+      return self.registry + "/" + self.repository
+    return self.repository
+
+  # Repository path up to the last "/", e.g. the namespace of registry/namespace/image
+  def Namespace(self):
+    index = self.repository.rfind("/")
+    if index == -1:
+      return self.Name()
+    if self.registry:
+      return self.registry + "/" + self.repository[:index]
+    return self.repository[:index]
+
+  def WithRegistry(self, registry):
+    return ImageRef(registry, self.repository, self.tag, self.digest)
+
+
+def ParseImageRef(image):
+  if isinstance(image, ImageRef):
+    return image
+  digest = ""
+  index = image.find("@")
+  if index != -1:
+    digest = image[index + 1:]
+    image = image[:index]
+
+  registry = ""
+  index = image.find("/")
+  if index != -1:
+    registry = image[:index]
+    image = image[index + 1:]
+
+  tag = ""
+  index = image.rfind(":")
+  if index != -1:
+    tag = image[index + 1:]
+    image = image[:index]
+  return ImageRef(registry, image, tag, digest)
+
+
+# Insertion ordered set of image references
+class OrderedImageSet:
+  __slots__ = ("images",)
+
+  def __init__(self, images=()):
+    self.images = {}
+    for image in images:
+      self.Add(image)
+
+  def Add(self, image):
+    ref = ParseImageRef(image)
+    if ref not in self.images:
+      self.images[ref] = None
+    return ref
+
+  def Discard(self, image):
+    self.images.pop(ParseImageRef(image), None)
+
+  def __contains__(self, image):
+    return ParseImageRef(image) in self.images
+
+  def __iter__(self):
+    return iter(self.images)
+
+  def __len__(self):
+    return len(self.images)
+
+
+# Images that should never be mirrored. Each line of a deny list is one of
+#   registry/repository[:tag]@sha256:...   an exact image reference
+#   sha256:...                             a digest, in any repository
+#   registry/namespace/*                   a glob over the reference
+# Blank lines and lines starting with # are ignored.
+class ImageDenyList:
+  def __init__(self):
+    self.references = set()
+    self.digests = set()
+    self.globs = []
+    self.glob_regex = None
+
+  def Load(self, path):
+    with open(path) as f:
+      for line in f:
+        self.Add(line.strip())
+
+  def Add(self, pattern):
+    if not pattern or pattern.startswith("#"):
+      return
+    if pattern.startswith("sha256:"):
+      self.digests.add(pattern)
+    elif any(c in pattern for c in "*?["):
+      self.globs.append(pattern)
+      self.glob_regex = None
+    else:
+      self.references.add(str(ParseImageRef(pattern)))
+
+  def Matches(self, image):
+    ref = ParseImageRef(image)
+    if ref.reference in self.references or ref.digest in self.digests:
+      return True
+    if self.globs and self.glob_regex is None:
+      # Compiled once on first use, recompiling per Add is quadratic in the number of globs
+      self.glob_regex = re.compile("|".join(fnmatch.translate(glob) for glob in self.globs))
+    if self.glob_regex is not None:
+      return self.glob_regex.match(ref.reference) is not None or self.glob_regex.match(ref.Name()) is not None
+    return False
+
+  def __len__(self):
+    return len(self.references) + len(self.digests) + len(self.globs)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import json
+import time
+import bisect
+import threading
+import atomicfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Upper bounds in seconds of the per image copy latency histogram
+LATENCY_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800]
+
+
+# Timings and counters collected over a run, safe to update from worker threads
+class RunMetrics:
+  def __init__(self):
+    self.started = datetime.now(timezone.utc)
+    self.start_time = time.monotonic()
+    self.phases = []
+    self.images = []
+    self.counters = {}
+    self.lock = threading.Lock()
+
+  @contextmanager
+  def Phase(self, name):
+    start = time.monotonic()
+    status = "failed"
+    try:
+      yield
+      status = "ok"
+    finally:
+      with self.lock:
+        self.phases.append({"name": name, "seconds": round(time.monotonic() - start, 3), "status": status})
+
+  def Count(self, name, value=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def RecordImage(self, image, registry, seconds, retries, success, size=None):
+    with self.lock:
+      self.images.append({
+          "image": image,
+          "registry": registry,
+          "seconds": round(seconds, 3),
+          "retries": retries,
+          "status": "ok" if success else "failed",
+          "bytes": size})
+
+  # Cumulative latency histogram in Prometheus style, {"1": n, ..., "+Inf": n}
+  def LatencyHistogram(self, images):
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    for image in images:
+      counts[bisect.bisect_left(LATENCY_BUCKETS, image["seconds"])] += 1
+    histogram = {}
+    total = 0
+    for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], counts):
+      total += count
+      histogram[str(bound)] = total
+    return histogram
+
+  def Summary(self):
+    with self.lock:
+      images = list(self.images)
+      phases = list(self.phases)
+      counters = dict(self.counters)
+    elapsed = time.monotonic() - self.start_time
+    copied = [image for image in images if image["status"] == "ok"]
+    copy_seconds = sum(image["seconds"] for image in images)
+    copied_bytes = sum(image["bytes"] or 0 for image in copied)
+    registries = {}
+    for image in images:
+      registry = registries.setdefault(image["registry"], {"images": 0, "failed": 0, "retries": 0, "seconds": 0.0})
+      registry["images"] += 1
+      registry["retries"] += image["retries"]
+      registry["seconds"] = round(registry["seconds"] + image["seconds"], 3)
+      if image["status"] != "ok":
+        registry["failed"] += 1
+    mirror_seconds = sum(phase["seconds"] for phase in phases if phase["name"] == "mirror")
+    return {
+        "started": self.started.isoformat(),
+        "seconds": round(elapsed, 3),
+        "phases": phases,
+        "counters": counters,
+        "images": {
+            "copied": len(copied),
+            "failed": len(images) - len(copied),
+            "retries": sum(image["retries"] for image in images),
+            "copy_seconds": round(copy_seconds, 3),
+            "bytes": copied_bytes,
+            "images_per_second": round(len(copied) / mirror_seconds, 3) if mirror_seconds else None,
+            "bytes_per_second": round(copied_bytes / mirror_seconds) if mirror_seconds and copied_bytes else None,
+            "latency_histogram": self.LatencyHistogram(images)},
+        "registries": registries}
+
+  # JSON summary plus one JSON line per image copy
+  def WriteReport(self, report_path, images_path):
+    with atomicfile.AtomicFile(report_path) as f:
+      json.dump(self.Summary(), f, indent=2)
+    with self.lock:
+      images = list(self.images)
+    with atomicfile.AtomicFile(images_path) as f:
+      for image in images:
+        f.write(json.dumps(image) + "\n")
+
+  # Prometheus node_exporter textfile collector format, written atomically
+  def WritePrometheus(self, path):
+    summary = self.Summary()
+    lines = [
+        "# HELP operator_mirror_run_seconds Wall time of the mirror run.",
+        "# TYPE operator_mirror_run_seconds gauge",
+        "operator_mirror_run_seconds " + str(summary["seconds"]),
+        "# HELP operator_mirror_phase_seconds Wall time of each phase of the mirror run.",
+        "# TYPE operator_mirror_phase_seconds gauge"]
+    for phase in summary["phases"]:
+      lines.append('operator_mirror_phase_seconds{phase="' + phase["name"] + '"} ' + str(phase["seconds"]))
+    lines += [
+        "# HELP operator_mirror_images_total Images copied, by result.",
+        "# TYPE operator_mirror_images_total counter",
+        'operator_mirror_images_total{status="ok"} ' + str(summary["images"]["copied"]),
+        'operator_mirror_images_total{status="failed"} ' + str(summary["images"]["failed"]),
+        "# HELP operator_mirror_image_retries_total Image copy retries.",
+        "# TYPE operator_mirror_image_retries_total counter",
+        "operator_mirror_image_retries_total " + str(summary["images"]["retries"]),
+        "# HELP operator_mirror_image_copy_seconds Image copy latency.",
+        "# TYPE operator_mirror_image_copy_seconds histogram"]
+    for bound, count in summary["images"]["latency_histogram"].items():
+      lines.append('operator_mirror_image_copy_seconds_bucket{le="' + bound + '"} ' + str(count))
+    lines.append("operator_mirror_image_copy_seconds_sum " + str(summary["images"]["copy_seconds"]))
+    lines.append("operator_mirror_image_copy_seconds_count " + str(summary["images"]["copied"] + summary["images"]["failed"]))
+    for name, value in sorted(summary["counters"].items()):
+      lines.append('operator_mirror_events_total{event="' + name + '"} ' + str(value))
+    with atomicfile.AtomicFile(path) as f:
+      f.write("\n".join(lines) + "\n")
@@ -2,18 +2,37 @@
 import os
 import sys
 import re
-import tarfile
 import yaml
 import subprocess
 import argparse
-import urllib.request
 from jinja2 import Template
 from pathlib import Path
 import upgradepath
-import sqlite3
+import mirrorstate
+import fbc
+import cache
+import pipeline
+import metrics
+import time
+import asyncio
+from imageref import ImageRef, OrderedImageSet, ImageDenyList, ParseImageRef
+import catalogdb
+import imagearchive
+import mirrorplan
+import catalogdiff
+import mirrorpolicy
+import mirrorbatch
+import registryclient
+import copy
+import atomicfile
+from contextlib import ExitStack
 import json
 import shutil
-from natsort import natsorted
+import threading
+import heapq
+import retrypolicy
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 def is_number(string):
   try:
@@ -72,10 +91,43 @@ group.add_argument(
     "--operator-yaml-file",
     metavar="FILE",
     help="Specify a YAML file containing operator list to mirror")
+group.add_argument(
+    "--batch-config",
+    metavar="FILE",
+    help="Specify a YAML file listing several catalogs, channels and operator lists to process in one run")
+group.add_argument(
+    "--from-dir",
+    metavar="DIR",
+    help="Push the images and catalogs of an archive written by --to-dir to the offline registries")
+parser.add_argument(
+    "--to-dir",
+    default="",
+    metavar="DIR",
+    help="Write the related images and pruned catalogs to an archive directory instead of pushing them to the registries")
+parser.add_argument(
+    "--catalog-workers",
+    type=int,
+    default=4,
+    help="Number of catalogs to render and prune concurrently in batch mode. Default 4")
 parser.add_argument(
     "--icsp-scope",
     default="namespace",
     help="Scope of registry mirrors in imagecontentsourcepolicy file. Allowed values: namespace, registry. Defaults to: namespace")
+parser.add_argument(
+    "--icsp-max-entries",
+    type=int,
+    default=0,
+    help="Merge mirror sources into common parent paths until there are at most this many. 0 means only drop sources nested in another one. Default 0")
+parser.add_argument(
+    "--icsp-max-size",
+    type=int,
+    default=262144,
+    help="Maximum size in bytes of one mirror policy document, larger policies are split over several documents. 0 disables splitting. Default 262144")
+parser.add_argument(
+    "--icsp-format",
+    default="icsp",
+    choices=["icsp", "idms", "both"],
+    help="Write an ImageContentSourcePolicy, ImageDigestMirrorSet/ImageTagMirrorSet (OCP 4.13+) or both. Default icsp")
 parser.add_argument(
     "--output",
     default="publish",
@@ -116,6 +168,135 @@ parser.add_argument(
     "--custom-operator-catalog-name",
     default="custom-redhat-operators",
     help="custom operator catalog name")
+parser.add_argument(
+    "--known-bad-images",
+    action="append",
+    default=[],
+    metavar="FILE",
+    help="Additional file listing images, digests or repository globs never to mirror. Can be repeated")
+parser.add_argument(
+    "--diff-baseline",
+    default="",
+    metavar="INDEX",
+    help="Earlier version of the operator index (image reference, rendered catalog file or index.db) to diff against. Only images it did not have are mirrored")
+parser.add_argument(
+    "--plan",
+    default="False",
+    help="Boolean: Only work out what would be mirrored and how much would be transferred, write it to the plan file and stop. Default is False")
+parser.add_argument(
+    "--plan-file",
+    default="",
+    help="Where --plan writes the mirror plan. Default <name>--mirror_plan.json in the publish directory of the plan directory")
+parser.add_argument(
+    "--resume",
+    default="False",
+    help="Boolean: Continue the last unfinished run from its journal, only mirroring the images it did not finish. Default is False")
+parser.add_argument(
+    "--journal-file",
+    default="",
+    help="Journal of the current run used by --resume. Default mirror-journal.jsonl in the script directory")
+parser.add_argument(
+    "--metrics-textfile",
+    default="",
+    metavar="FILE",
+    help="Also write run metrics to this file in Prometheus textfile collector format")
+parser.add_argument(
+    "--mirror-max-attempts",
+    type=int,
+    default=5,
+    help="Number of times an image copy is attempted before it is reported as failed. Default 5")
+parser.add_argument(
+    "--mirror-retry-base-delay",
+    type=float,
+    default=2.0,
+    help="Seconds of backoff before the first retry of an image copy, doubled on every further retry and jittered. Default 2")
+parser.add_argument(
+    "--mirror-retry-max-delay",
+    type=float,
+    default=60.0,
+    help="Upper bound in seconds of the backoff between image copy retries. Default 60")
+parser.add_argument(
+    "--circuit-breaker-threshold",
+    type=int,
+    default=5,
+    help="Consecutive failed copies from one source registry before copies from it are paused. Default 5")
+parser.add_argument(
+    "--circuit-breaker-cooldown",
+    type=float,
+    default=30.0,
+    help="Seconds copies from a failing source registry are paused for. Default 30")
+parser.add_argument(
+    "--circuit-breaker-max-probes",
+    type=int,
+    default=3,
+    help="Consecutive failed probe copies after which every remaining image of a paused registry is failed. 0 never gives up. Default 3")
+parser.add_argument(
+    "--mirror-backend",
+    default="skopeo",
+    choices=["skopeo", "skopeo-sync", "oc"],
+    help="Tool that copies the related images: skopeo copy per image, skopeo sync per batch of repositories or one oc image mirror. Default skopeo")
+parser.add_argument(
+    "--registry-connections",
+    type=int,
+    default=8,
+    help="Keep-alive connections per registry of the built-in client used for manifest lookups, 0 uses skopeo inspect instead. Default 8")
+parser.add_argument(
+    "--skopeo-path",
+    default="skopeo",
+    help="Full path of the skopeo binary. Default skopeo")
+parser.add_argument(
+    "--mirror-workers",
+    type=int,
+    default=1,
+    help="Number of images to mirror concurrently. Default 1")
+parser.add_argument(
+    "--mirror-workers-per-registry",
+    type=int,
+    default=0,
+    help="Maximum number of concurrent copies from a single source registry. 0 means no limit. Default 0")
+parser.add_argument(
+    "--mirror-state-file",
+    default="",
+    help="Ledger of images already mirrored by digest, used to skip them on later runs. Default mirror-state.json in the script directory")
+parser.add_argument(
+    "--incremental-mirror",
+    default="True",
+    help="Boolean: Skip images the mirror state ledger says are already in the destination registry. Default is True")
+parser.add_argument(
+    "--verify-mirrored-images",
+    default="False",
+    help="Boolean: Confirm images recorded in the mirror state ledger still exist in the destination registry before skipping them. Default is False")
+parser.add_argument(
+    "--cache-dir",
+    default="",
+    help="Directory for caches kept between runs. Default cache in the script directory")
+parser.add_argument(
+    "--render-cache-max-entries",
+    type=int,
+    default=10,
+    help="Number of rendered catalog indexes to keep in the cache, 0 disables the cache. Default 10")
+parser.add_argument(
+    "--render-cache-max-size",
+    type=float,
+    default=5,
+    help="Maximum size in GiB of the rendered catalog cache. Default 5")
+parser.add_argument(
+    "--blob-cache-max-size",
+    type=float,
+    default=0,
+    help="Maximum size in GiB of the local image layer cache that image copies are pulled through, 0 disables the cache. Default 0")
+parser.add_argument(
+    "--tools-mirror-url",
+    default="https://mirror.openshift.com/pub/openshift-v4/clients/ocp/",
+    help="Base URL to download the opm and oc clients from. Default https://mirror.openshift.com/pub/openshift-v4/clients/ocp/")
+parser.add_argument(
+    "--tools-channel",
+    default="fast",
+    help="Release channel of the opm and oc clients. Default fast")
+parser.add_argument(
+    "--offline-tools",
+    default="False",
+    help="Boolean: Only use opm and oc clients already in the tool cache, never download them. Default is False")
 
 try:
   args = parser.parse_args()
@@ -123,6 +304,15 @@ except Exception as exc:
   print("An exception occurred while parsing arguements list")
   print(exc)
   sys.exit(1)
+if args.from_dir and args.to_dir:
+  print("--to-dir and --from-dir can not be used together")
+  sys.exit(1)
+if args.mirror_backend != "skopeo" and (args.from_dir or args.to_dir):
+  print("--to-dir and --from-dir need --mirror-backend=skopeo")
+  sys.exit(1)
+if args.mirror_backend == "skopeo-sync" and args.add_tags_to_images_mirrored_by_digest.lower() == "true":
+  print("--mirror-backend=skopeo-sync keeps digests and can not be used with --add-tags-to-images-mirrored-by-digest")
+  sys.exit(1)
 
 # Global Variables
 if args.run_dir != "":
@@ -130,8 +320,14 @@ if args.run_dir != "":
 else:
   script_root_dir = os.path.dirname(os.path.realpath(__file__))
 
-publish_root_dir = os.path.join(script_root_dir, args.output)
-run_root_dir = os.path.join(script_root_dir, "run")
+if args.plan.lower() == "true":
+  # A plan gets publish and run dirs of its own, so it never wipes the output of
+  # the last real run or the pruned catalogs --resume still needs
+  publish_root_dir = os.path.join(script_root_dir, "plan", args.output)
+  run_root_dir = os.path.join(script_root_dir, "plan", "run")
+else:
+  publish_root_dir = os.path.join(script_root_dir, args.output)
+  run_root_dir = os.path.join(script_root_dir, "run")
 mirror_images = args.mirror_images
 add_tags_to_images_mirrored_by_digest = args.add_tags_to_images_mirrored_by_digest
 delete_publish = args.delete_publish
@@ -155,6 +351,18 @@ custom_redhat_operators_image_name = "custom-" + args.operator_image_name
 custom_redhat_operators_display_name = re.sub(r'^redhat-', 'red hat-', args.operator_image_name)
 custom_redhat_operators_display_name = re.sub('-', ' ', custom_redhat_operators_display_name).title()
 
+batch_config = None
+output_name = custom_redhat_operators_image_name
+if args.batch_config:
+  try:
+    with open(args.batch_config) as f:
+      batch_config = yaml.safe_load(f)
+    output_name = batch_config.get("name", "custom-operators-batch")
+  except Exception as exc:
+    print("An exception occurred while reading the batch config file")
+    print(exc)
+    sys.exit(1)
+
 if args.custom_operator_catalog_image_url:
   print("--custom-operator-catalog-image-url is no longer supported. \n")
   print("Use --custom-operator-catalog-image-and-tag instead")
@@ -169,96 +377,447 @@ else:
 oc_cli_path = args.oc_cli_path
 
 image_content_source_policy_output_file = os.path.join(
-    publish_root_dir, custom_redhat_operators_image_name + '--icsp.yaml')
-catalog_source_output_file = os.path.join(
-    publish_root_dir, custom_redhat_operators_image_name + '--catalogsource.yaml')
+    publish_root_dir, output_name + '--icsp.yaml')
 mapping_file=os.path.join(
-    publish_root_dir, custom_redhat_operators_image_name + '--mapping.txt')
+    publish_root_dir, output_name + '--mapping.txt')
+image_digest_mirror_set_output_file = os.path.join(
+    publish_root_dir, output_name + '--idms.yaml')
+image_tag_mirror_set_output_file = os.path.join(
+    publish_root_dir, output_name + '--itms.yaml')
+oc_mapping_file = os.path.join(
+    publish_root_dir, output_name + '--oc_mapping.txt')
+mirror_batch_dir = os.path.join(run_root_dir, "mirror-batches")
+delta_mapping_file = os.path.join(
+    publish_root_dir, output_name + '--delta_mapping.txt')
 image_manifest_file = os.path.join(
-    publish_root_dir, custom_redhat_operators_image_name + '--image_manifest.txt')
-mirror_summary_file = os.path.join(
-    publish_root_dir, custom_redhat_operators_image_name + '--mirror_log.txt')
+    publish_root_dir, output_name + '--image_manifest.txt')
+run_report_file = os.path.join(
+    publish_root_dir, output_name + '--run_report.json')
+run_images_file = os.path.join(
+    publish_root_dir, output_name + '--run_images.jsonl')
+if args.plan_file != "":
+  plan_file = args.plan_file
+else:
+  plan_file = os.path.join(publish_root_dir, output_name + '--mirror_plan.json')
+if args.mirror_state_file != "":
+  mirror_state_file = args.mirror_state_file
+else:
+  mirror_state_file = os.path.join(script_root_dir, "mirror-state.json")
+if args.cache_dir != "":
+  cache_root_dir = args.cache_dir
+else:
+  cache_root_dir = os.path.join(script_root_dir, "cache")
+# Archive exports already store every layer once, imports read local layouts and
+# the bulk backends copy straight between registries
+if args.blob_cache_max_size > 0 and not args.to_dir and not args.from_dir and args.mirror_backend == "skopeo":
+  blob_cache = cache.BlobCache(os.path.join(cache_root_dir, "blobs"), int(args.blob_cache_max_size * 1024 ** 3))
+else:
+  blob_cache = None
+# Digest lookups, existence checks and plan sizing talk to the registries directly
+if args.registry_connections > 0:
+  registry_client = registryclient.RegistryClient(args.authfile, args.registry_connections,
+      [args.registry_olm.split("/")[0], args.registry_catalog.split("/")[0]])
+else:
+  registry_client = None
+print_lock = threading.Lock()
+run_metrics = metrics.RunMetrics()
+if args.journal_file != "":
+  journal_file = args.journal_file
+else:
+  journal_file = os.path.join(script_root_dir, "mirror-journal.jsonl")
 
 def main():
   run_temp = os.path.join(run_root_dir, "temp")
-  mirror_summary_path = Path(mirror_summary_file)
+
+  journal = mirrorstate.MirrorJournal(journal_file)
+  plan = args.plan.lower() == "true"
+  resume = False
+  if args.resume.lower() == "true" and not plan:
+    resume = journal.Load()
+    if not resume:
+      print("--resume=true   No unfinished run found in " + journal_file + ", starting a new run")
 
   # Create publish, run and temp paths
-  if delete_publish.lower() == "true":
+  if delete_publish.lower() == "true" and not resume:
     print("Will delete the publish dir...")
     delete_publish_bool = True
   else:
     print("--delete-publish=false   Skipping deleting the publish dir")
     delete_publish_bool = False
   RecreatePath(publish_root_dir, delete_publish_bool)
-  RecreatePath(run_root_dir)
-  RecreatePath(run_temp)
+  # Keep the run dir of an interrupted run, it holds the pruned catalogs not built yet
+  RecreatePath(run_root_dir, not resume)
+  RecreatePath(run_temp, not resume)
 
   print("Starting Catalog Build and Mirror...")
+  if resume:
+    catalogs, images, delta_images = ResumeFromJournal(journal, run_temp)
+  else:
+    if args.from_dir:
+      catalogs, images = LoadArchive()
+    else:
+      catalogs, images = PrepareCatalogs(run_temp)
+    delta_images = GetDeltaImages(catalogs, images)
+    if plan:
+      RunPhase("plan", CreateMirrorPlan, images if delta_images is None else delta_images, catalogs)
+      WriteRunReport()
+      subprocess.run("sudo rm -rf {}".format(run_root_dir), shell=True, check=True)
+      return
+    journal.Start(
+        [{"name": catalog.custom_image_name, "build_path": catalog.build_path} for catalog in catalogs],
+        [str(image) for image in images],
+        None if delta_images is None else [str(image) for image in delta_images])
+  # With a --diff-baseline only the images the baseline did not have are copied,
+  # the publish files still cover every image the catalogs reference
+  mirror_set = images if delta_images is None else delta_images
+
+  # Catalog image builds, image mirroring and the publish files don't depend on each other
+  stages = [BuildAndPushCatalog(catalog, journal) for catalog in catalogs if catalog.build_path]
+  stages += [PushArchivedCatalog(catalog, journal) for catalog in catalogs if catalog.archive_path]
+  if mirror_images.lower() == "true":
+    print("Mirroring related images to offline registry...")
+    stages.append(lambda: RunPhase("mirror", MirrorImagesToLocalRegistry, mirror_set, journal))
+  else:
+    print("--mirror-images=false   Skipping image mirroring")
+  # The mirror names in the publish files belong to the registry the archive is loaded into
+  if not args.to_dir:
+    stages.append(lambda: RunPhase("publish-files", CreatePublishFiles, images, catalogs, delta_images))
+  failures = [failure for failure in asyncio.run(pipeline.RunStages(stages)) if failure is not None]
+  if args.to_dir:
+    WriteArchive(mirror_set, catalogs)
+  WriteRunReport()
+  if not failures and not any(state == "failed" for state in journal.images.values()):
+    journal.MarkComplete()
+  journal.Close()
+  if failures:
+    print("The following steps failed:")
+    PrintBreakLine()
+    for failure in failures:
+      print(repr(failure))
+    PrintBreakLine()
+    sys.exit(1)
+
+  print("Catalogue creation and image mirroring complete")
+  if args.to_dir:
+    print("Copy " + args.to_dir + " to the disconnected site and run the script there with --from-dir")
+  else:
+    print("See Publish folder for the image content source policy and catalog source yaml files to apply to your cluster")
+
+  cmd_args = "sudo rm -rf {}".format(run_root_dir)
+  subprocess.run(cmd_args, shell=True, check=True)
+
+
+
+# Render and prune the catalogs, returns them with the de-duplicated images to mirror
+def PrepareCatalogs(run_temp):
   print("Getting opm CLI...")
   if args.opm_path != "":
     opm_cli_path = args.opm_path
   else:
-    opm_cli_path = GetOpmCli(run_temp)
+    with run_metrics.Phase("get-opm"):
+      opm_cli_path = GetOpmCli(run_temp)
 
   print("Getting the list of operators for custom catalogue..")
-  operators = GetWhiteListedOperators()
+  catalogs = GetCatalogSpecs(run_temp)
 
   # # NEED TO BE LOGGED IN TO REGISTRY.REDHAT.IO WITHOUT AUTHFILE ARGUMENT
+  InstallAuthFile()
   print("Pruning OLM catalogue...")
-  if int(operator_channel.split('.')[0]) > 3 and int(operator_channel.split('.')[1]) > 10:
-      operators = PruneFileBasedCatalog(opm_cli_path, operators, run_temp)
+  with run_metrics.Phase("prune"):
+    PruneCatalogs(opm_cli_path, catalogs)
+  operators = [operator for catalog in catalogs for operator in catalog.operators]
+
+  return catalogs, RemoveKnownBadImages(getImages(operators))
+
+
+# Catalogs and images of the interrupted run, exactly as it snapshotted them
+def ResumeFromJournal(journal, run_temp):
+  print("Resuming the run started " + journal.snapshot["started"] + " from " + journal_file)
+  InstallAuthFile()
+  if args.from_dir:
+    specs, _ = LoadArchive()
+  else:
+    specs = GetCatalogSpecs(run_temp, read_operators=False)
+  catalogs = []
+  for catalog in specs:
+    snapshot = next((c for c in journal.snapshot["catalogs"] if c["name"] == catalog.custom_image_name), None)
+    if snapshot is None:
+      print("Catalog " + catalog.custom_image_name + " is not part of the run being resumed")
+      sys.exit(1)
+    if journal.IsCatalogDone(catalog.custom_image_name):
+      catalog.archive_path = ""
+    elif snapshot["build_path"]:
+      if not os.path.isdir(snapshot["build_path"]):
+        print("The pruned catalog of " + catalog.custom_image_name + " is gone, start a new run instead")
+        sys.exit(1)
+      catalog.build_path = snapshot["build_path"]
+    catalogs.append(catalog)
+  journal.Open()
+  images = OrderedImageSet(journal.snapshot["images"])
+  delta_images = None
+  if "mirror_images" in journal.snapshot:
+    delta_images = OrderedImageSet(journal.snapshot["mirror_images"])
+  mirror_set = images if delta_images is None else delta_images
+  remaining = sum(1 for image in mirror_set if not journal.IsImageDone(str(image)))
+  print(str(remaining) + " of " + str(len(mirror_set)) + " images left to mirror")
+  return catalogs, images, delta_images
+
+
+# Catalogs and images of an archive written by --to-dir, retargeted at the offline registries
+def LoadArchive():
+  try:
+    index = imagearchive.ReadArchiveIndex(args.from_dir)
+    catalogs = []
+    for entry in index["catalogs"]:
+      catalog = CatalogSpec(entry["operator_image_name"], entry["catalog_image_url"], entry["operator_channel"],
+          args.registry_catalog + "/" + entry["image"], [])
+      catalog.custom_image_name = entry["name"]
+      catalog.display_name = entry["display_name"]
+      catalog.archive_path = entry["path"]
+      catalogs.append(catalog)
+    images = OrderedImageSet(image["source"] for image in index["images"])
+  except (OSError, ValueError, KeyError) as exc:
+    print("An exception occurred while reading the archive in " + args.from_dir)
+    print(exc)
+    sys.exit(1)
+  InstallAuthFile()
+  print("Loaded " + str(len(images)) + " images and " + str(len(catalogs)) + " catalogs from " + args.from_dir)
+  return catalogs, images
+
+
+# Record what made it into the --to-dir archive, images or catalogs that failed are left out
+def WriteArchive(images, catalogs):
+  archived_images = [image for image in images
+                     if imagearchive.IsLayoutComplete(args.to_dir, imagearchive.ImageLayoutPath(image))]
+  archived_catalogs = []
+  for catalog in catalogs:
+    path = imagearchive.CatalogLayoutPath(catalog.custom_image_name)
+    if not imagearchive.IsLayoutComplete(args.to_dir, path):
+      continue
+    archived_catalogs.append({
+        "name": catalog.custom_image_name,
+        "display_name": catalog.display_name,
+        "operator_image_name": catalog.operator_image_name,
+        "catalog_image_url": catalog.catalog_image_url,
+        "operator_channel": catalog.operator_channel,
+        "image": catalog.custom_catalog_image_url[len(args.registry_catalog) + 1:],
+        "path": path})
+  index_path = imagearchive.WriteArchiveIndex(args.to_dir, archived_images, archived_catalogs)
+  size = imagearchive.ArchiveSize(args.to_dir)
+  print("Wrote " + index_path + ": " + str(len(archived_images)) + " of " + str(len(images)) + " images, "
+        + str(len(archived_catalogs)) + " catalogs, " + str(round(size / 1024 ** 2, 1)) + " MiB")
+
+
+# Images of catalogs with a --diff-baseline that the baseline did not reference,
+# plus every image of catalogs without one. None if no catalog has a baseline.
+def GetDeltaImages(catalogs, images):
+  if not any(catalog.baseline_images is not None for catalog in catalogs):
+    return None
+  delta_images = OrderedImageSet()
+  for catalog in catalogs:
+    for image in getImages(catalog.operators):
+      if image not in images:
+        continue
+      if catalog.baseline_images is None or image not in catalog.baseline_images:
+        delta_images.Add(image)
+  print(str(len(delta_images)) + " of " + str(len(images)) + " images are new since the baseline catalogs")
+  return delta_images
+
+
+# Select the same operators from the --diff-baseline version of the catalog and
+# record what changed since. Sets catalog.baseline_images.
+def DiffCatalogAgainstBaseline(opm_cli_path, catalog):
+  local_file = os.path.isfile(catalog.diff_baseline)
+  baseline = copy.copy(catalog)
+  baseline.index_image_url = catalog.diff_baseline
+  if not local_file:
+    baseline.catalog_image_url = ParseImageRef(catalog.diff_baseline).Name()
+  baseline.run_temp = os.path.join(catalog.run_temp, "baseline")
+  os.makedirs(baseline.run_temp, exist_ok=True)
+  operators = [OperatorSpec(operator.name, operator.start_version) for operator in catalog.operators]
+
+  print("Reading baseline catalog " + catalog.diff_baseline + "...")
+  with run_metrics.Phase("diff:" + catalog.custom_image_name):
+    if catalog.IsFileBased():
+      if local_file:
+        rendered = catalog.diff_baseline
+      else:
+        rendered = GetRenderedCatalog(opm_cli_path, baseline, os.path.join(baseline.run_temp, "data.out"))
+      operators = SelectFileBasedCatalogObjects(fbc.ReadFileBasedCatalog(rendered), operators)
+    else:
+      if local_file:
+        db_path = catalog.diff_baseline
+      else:
+        db_path = ExtractIndexDb(baseline, catalog.diff_baseline)
+      catalog_db = catalogdb.CatalogDb(db_path)
+      for operator in operators:
+        operator.upgrade_path = upgradepath.GetShortestUpgradePath(operator.name, operator.start_version, catalog_db)
+      GetImageListToMirror(operators, catalog_db)
+      catalog_db.Close()
+
+  diff = catalogdiff.DiffCatalogs(operators, catalog.operators)
+  diff_path = os.path.join(publish_root_dir, catalog.custom_image_name + '--catalog_diff.json')
+  catalogdiff.WriteDiff(diff_path, catalog.diff_baseline, catalog.index_image_url, diff)
+  print(catalog.custom_image_name + " since " + catalog.diff_baseline + ": "
+        + str(len(diff["added_bundles"])) + " bundles added, " + str(len(diff["removed_bundles"])) + " removed, "
+        + str(len(diff["changed_bundles"])) + " changed, " + str(len(diff["added_images"])) + " new images")
+  catalog.baseline_images = getImages(operators)
+
+
+def RunPhase(name, function, *function_args):
+  with run_metrics.Phase(name):
+    return function(*function_args)
+
+
+# Run report (JSON summary and per image JSON lines) in the publish dir, and optionally a Prometheus textfile
+def WriteRunReport():
+  print("Writing run report...")
+  run_metrics.WriteReport(run_report_file, run_images_file)
+  if args.metrics_textfile:
+    run_metrics.WritePrometheus(args.metrics_textfile)
+
+
+# Catalogs to process: the one described by the command line, or every entry of --batch-config
+def GetCatalogSpecs(run_temp, read_operators=True):
+  if batch_config is None:
+    catalog = CatalogSpec(args.operator_image_name, args.operator_catalog_image_url, operator_channel,
+        custom_redhat_operators_catalog_image_url, GetWhiteListedOperators() if read_operators else [])
+    catalog.run_temp = run_temp
+    catalog.diff_baseline = args.diff_baseline
+    return [catalog]
+
+  catalogs = []
+  try:
+    for entry in batch_config["catalogs"]:
+      image_name = entry.get("operator_image_name", args.operator_image_name)
+      channel = str(entry.get("operator_channel", args.operator_channel))
+      if entry.get("custom_catalog_image_and_tag"):
+        custom_catalog_image_url = args.registry_catalog + "/" + entry["custom_catalog_image_and_tag"]
+      else:
+        custom_catalog_image_url = args.registry_catalog + "/" + entry.get("custom_catalog_name", "custom-" + image_name) + ":" + str(entry.get("catalog_version", args.catalog_version))
+      catalog = CatalogSpec(image_name, entry.get("catalog_image_url", args.operator_catalog_image_url), channel,
+          custom_catalog_image_url, GetOperatorSpecs(entry["operators"]))
+      if entry.get("catalog_source_name"):
+        catalog.custom_image_name = entry["catalog_source_name"]
+      catalog.diff_baseline = entry.get("diff_baseline", "")
+      catalog.run_temp = os.path.join(run_temp, catalog.custom_image_name)
+      catalogs.append(catalog)
+  except Exception as exc:
+    print("An exception occurred while reading the batch config file")
+    print(exc)
+    sys.exit(1)
+
+  names = [catalog.custom_image_name for catalog in catalogs]
+  duplicates = set(name for name in names if names.count(name) > 1)
+  if duplicates:
+    print("Catalog source names must be unique, set catalog_source_name for: " + ", ".join(sorted(duplicates)))
+    sys.exit(1)
+  return catalogs
+
+
+# Render and prune every catalog, several at a time in batch mode
+def PruneCatalogs(opm_cli_path, catalogs):
+  for catalog in catalogs:
+    RecreatePath(catalog.run_temp)
+  workers = max(1, min(args.catalog_workers, len(catalogs)))
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = [executor.submit(PruneCatalog, opm_cli_path, catalog) for catalog in catalogs]
+    for future in futures:
+      future.result()
+
+
+def PruneCatalog(opm_cli_path, catalog):
+  mirror_summary_path = Path(os.path.join(publish_root_dir, catalog.custom_image_name + '--mirror_log.txt'))
+  if catalog.IsFileBased():
+      with run_metrics.Phase("prune:" + catalog.custom_image_name):
+        catalog.operators = PruneFileBasedCatalog(opm_cli_path, catalog)
       print("Writing summary data..")
-      CreateSummaryFileForFileBasedatalog(operators, mirror_summary_path)
+      CreateSummaryFileForFileBasedatalog(catalog.operators, mirror_summary_path)
   else:
-      PruneSqliteBasedCatalog(opm_cli_path, operators, run_temp)
+      if args.plan.lower() == "true":
+        # The full index answers the same queries, so a plan never builds or pushes a catalog
+        index_image_url = catalog.index_image_url
+      else:
+        with run_metrics.Phase("prune:" + catalog.custom_image_name):
+          PruneSqliteBasedCatalog(opm_cli_path, catalog)
+        index_image_url = catalog.custom_catalog_image_url
 
       print("Extracting custom catalogue database...")
-      db_path = ExtractIndexDb()
+      with run_metrics.Phase("extract-index-db:" + catalog.custom_image_name):
+        if args.to_dir and args.plan.lower() != "true":
+          db_path = ExtractLocalIndexDb(catalog)
+        else:
+          db_path = ExtractIndexDb(catalog, index_image_url)
+      catalog_db = catalogdb.CatalogDb(db_path)
 
       print("Create upgrade matrix for selected operators...")
-      for operator in operators:
-        operator.upgrade_path = upgradepath.GetShortestUpgradePath(operator.name, operator.start_version, db_path)
+      with run_metrics.Phase("upgrade-paths:" + catalog.custom_image_name):
+        for operator in catalog.operators:
+          operator.upgrade_path = upgradepath.GetShortestUpgradePath(operator.name, operator.start_version, catalog_db)
 
       print("Getting list of images to be mirrored...")
-      GetImageListToMirror(operators, db_path)
+      GetImageListToMirror(catalog.operators, catalog_db)
+      catalog_db.Close()
 
       print("Writing summary data..")
-      CreateSummaryFile(operators, mirror_summary_path)
+      CreateSummaryFile(catalog.operators, mirror_summary_path)
+  if catalog.diff_baseline:
+      DiffCatalogAgainstBaseline(opm_cli_path, catalog)
 
 
-  images = getImages(operators)
-  if mirror_images.lower() == "true":
-    print("Mirroring related images to offline registry...")
-    MirrorImagesToLocalRegistry(images)
+# Copy the pull secret to where opm looks for it
+def InstallAuthFile():
+  if args.authfile:
+    HOME = os.getenv('HOME')
+    docker_cfg = os.path.join(HOME, ".docker", "config.json")
+    os.makedirs(os.path.dirname(docker_cfg), exist_ok=True)
+    shutil.copyfile(args.authfile, docker_cfg)
   else:
-    print("--mirror-images=false   Skipping image mirroring")
-
+    print("You must pass an auth file with the '--authfile' option")
+    exit(1)
+
+
+# Work out each image's destination once and stream the manifest, mapping and
+# oc image mirror mapping files in a single pass, collecting the mirror policy
+# sources on the way. Every file is written through a temp file and renamed.
+def CreatePublishFiles(images, catalogs, delta_images=None):
+  print("Creating Mapping, Image manifest and oc image mirror mapping files...")
+  sources = set()
+  tag_sources = set()
+  with ExitStack() as stack:
+    manifest = stack.enter_context(atomicfile.AtomicFile(image_manifest_file))
+    mapping = stack.enter_context(atomicfile.AtomicFile(mapping_file))
+    oc_mapping = stack.enter_context(atomicfile.AtomicFile(oc_mapping_file))
+    delta_mapping = None
+    if delta_images is not None:
+      delta_mapping = stack.enter_context(atomicfile.AtomicFile(delta_mapping_file))
+    for image in images:
+      source_url = str(image)
+      mapping_line = source_url + "=" + WithoutDigest(args.registry_olm + "/" + image.repository, image.tag) + "\n"
+      manifest.write(source_url + "\n")
+      mapping.write(mapping_line)
+      oc_mapping.write(GetOcMappingLine(image) + "\n")
+      if delta_mapping is not None and image in delta_images:
+        delta_mapping.write(mapping_line)
+      source = GetPolicySource(image)
+      sources.add(source)
+      if image.tag and not image.digest:
+        tag_sources.add(source)
 
   print("Creating Image Content Source Policy YAML...")
-  CreateImageContentSourcePolicyFile(images)
-
-  print("Creating Mapping File...")
-  CreateMappingFile(images)
-
-  print("Creating Image manifest file...")
-  CreateManifestFile(images)
+  CreateImageContentSourcePolicyFile(sources, tag_sources)
 
   print("Creating Catalog Source YAML...")
-  CreateCatalogSourceYaml(custom_redhat_operators_catalog_image_url, custom_redhat_operators_image_name, custom_redhat_operators_display_name)
-
-  print("Catalogue creation and image mirroring complete")
-  print("See Publish folder for the image content source policy and catalog source yaml files to apply to your cluster")
-
-  cmd_args = "sudo rm -rf {}".format(run_root_dir)
-  subprocess.run(cmd_args, shell=True, check=True)
-
+  for catalog in catalogs:
+    CreateCatalogSourceYaml(catalog.custom_catalog_image_url, catalog.custom_image_name, catalog.display_name)
 
 
 def CreateSummaryFileForFileBasedatalog(operators, mirror_summary_path):
-  with open(mirror_summary_path, "w") as f:
+  with atomicfile.AtomicFile(str(mirror_summary_path)) as f:
     for operator in operators:
       f.write(operator.name + '\n')
+      if operator.start_version:
+        f.write("Upgrade Path: " + " -> ".join([operator.start_version] + operator.upgrade_path) + "\n")
       f.write("============================================================\n \n")
       for bundle in operator.operator_bundles:
         f.write(bundle.name + '\n')
@@ -271,40 +830,22 @@ def CreateSummaryFileForFileBasedatalog(operators, mirror_summary_path):
 
 
 def GetOcCli(run_temp):
-  base_url = "https://mirror.openshift.com/pub/openshift-v4/clients/ocp/"
-  archive_name = "openshift-client-linux.tar.gz"
-  ocp_bin_channel = "fast"
-  ocp_bin_release_url= base_url + ocp_bin_channel + "-" + ocp_version + "/" + archive_name
-  print(ocp_bin_release_url)
-  archive_file_path = os.path.join(run_temp, archive_name)
-
-  print("Downloading oc Cli...")
-  urllib.request.urlretrieve(ocp_bin_release_url, archive_file_path)
-
-  print("Extracting oc Cli...")
-  tf = tarfile.open(archive_file_path)
-  tf.extractall(run_root_dir)
-
-  return os.path.join(run_root_dir, "oc")
+  return GetClientTool("openshift-client-linux.tar.gz", "oc")
 
 
 def GetOpmCli(run_temp):
+  return GetClientTool("opm-linux.tar.gz", "opm")
 
-  base_url = "https://mirror.openshift.com/pub/openshift-v4/clients/ocp/"
-  archive_name = "opm-linux.tar.gz"
-  channel = "fast"
-  opm_bin_release_url = base_url + channel + "-" + ocp_version + "/" + archive_name
-  print(opm_bin_release_url)
-  archive_file_path = os.path.join(run_temp, archive_name)
-
-  print("Downloading opm Cli...")
-  urllib.request.urlretrieve(opm_bin_release_url, archive_file_path)
 
-  print("Extracting oc Cli...")
-  tf = tarfile.open(archive_file_path)
-  tf.extractall(run_root_dir)
-
-  return os.path.join(run_root_dir, "opm")
+# Fetch a client tool from the OpenShift mirror through the tool cache
+def GetClientTool(archive_name, binary_name):
+  tool_cache = cache.ToolCache(os.path.join(cache_root_dir, "tools"), args.tools_mirror_url, args.offline_tools.lower() == "true")
+  try:
+    return tool_cache.GetTool(args.tools_channel, ocp_version, archive_name, binary_name)
+  except Exception as exc:
+    print("An exception occurred while getting the " + binary_name + " CLI")
+    print(exc)
+    sys.exit(1)
 
 
 def GetWhiteListedOperators():
@@ -321,8 +862,7 @@ def GetWhiteListedOperators():
     elif args.operator_yaml_file:
       with open(args.operator_yaml_file) as f:
         data = yaml.safe_load(f)
-        for operator in data["operators"]:
-          operator_list.append(OperatorSpec(GetFieldValue(operator, "name"), GetFieldValue(operator, "start_version")))
+        operator_list = GetOperatorSpecs(data["operators"])
 
     elif args.operator_list:
       operators = args.operator_list
@@ -338,7 +878,7 @@ def GetWhiteListedOperators():
 
 
 def CreateSummaryFile(operators, mirror_summary_path):
-  with open(mirror_summary_path, "w") as f:
+  with atomicfile.AtomicFile(str(mirror_summary_path)) as f:
     for operator in operators:
       f.write(operator.name + '\n')
       f.write("Upgrade Path: ")
@@ -358,6 +898,17 @@ def CreateSummaryFile(operators, mirror_summary_path):
         f.write("---------------------------------------- \n \n")
       f.write("============================================================\n \n \n")
 
+# Operator specs from a YAML operator list, entries are either names or name/start_version maps
+def GetOperatorSpecs(entries):
+  operator_list = []
+  for operator in entries:
+    if isinstance(operator, str):
+      operator_list.append(OperatorSpec(operator, ""))
+    else:
+      operator_list.append(OperatorSpec(GetFieldValue(operator, "name"), str(GetFieldValue(operator, "start_version"))))
+  return operator_list
+
+
 # Returns an empty string if field does not exist
 def GetFieldValue(data, field):
   if field in data:
@@ -365,84 +916,24 @@ def GetFieldValue(data, field):
   else:
     return ""
 
-# Read data from rendered index
-def readJsonFile(cdata):
-    objects = []
-    with open(cdata) as f:
-        braceCount = 0
-        jsonStr = ''
-        for jsonObj in f:
-            braceCount += jsonObj.count('{')
-            braceCount -= jsonObj.count('}')
-            jsonStr += jsonObj
-            if braceCount == 0:
-                objects.append(json.loads(jsonStr))
-                jsonStr = ''
-    return objects
-
 # Create a custom catalog with selected operators from newer file based catalog
-def PruneFileBasedCatalog(opm_cli_path, operators, run_temp):
-    script_root_dir = os.path.dirname(os.path.realpath(__file__))
-    prune_path = os.path.join(run_temp, "pruned-catalog")
+def PruneFileBasedCatalog(opm_cli_path, catalog):
+    prune_path = os.path.join(catalog.run_temp, "pruned-catalog")
     configs_path = os.path.join(prune_path, "configs")
     cdata = os.path.join(configs_path, "data.out")
     pdata = os.path.join(configs_path, "index.json")
-    render_command = f"{opm_cli_path} render {redhat_operators_catalog_image_url}"
-    if args.authfile:
-        # Copy to correct folder for opm
-        HOME = os.getenv('HOME')
-        docker_cfg =  os.path.join(HOME, ".docker", "config.json")
-        shutil.copyfile(args.authfile, docker_cfg)
-    else:
-        print("You must pass an auth file with the '--authfile' option")
-        exit(1)
-    #os.chdir(run_temp)
 
     if not os.path.exists(configs_path):
         print(f"Creating config path ('{configs_path}')")
         os.makedirs(configs_path, exist_ok=True )
-    if not os.path.exists(cdata):
-        print(f"Running: '{render_command}'")
-        data = subprocess.run(render_command, shell=True, check=True, capture_output=True)
-        with open(cdata, 'a') as out:
-            out.write(data.stdout.decode('utf-8').strip())
-    objects = readJsonFile(cdata)
-    allowed = []
-    for operator in operators:
-       allowed.append(operator.name)
-    operators = []
-    for obj in objects:
-        tmp = []
-        version = ''
-        if obj['schema'] == 'olm.package' and obj['name'] in allowed:
-            operator = OperatorSpec(obj['name'], "")
-            operator.defaultChannel = obj['defaultChannel']
-            operator.icon = obj['icon']
-            operators.append(operator)
-        elif obj['schema'] == 'olm.channel' and obj['package'] in allowed and obj['name'] == operator.defaultChannel:
-            operator = next(operator for operator in operators if operator.name == obj['package'])
-            channel = OperatorChannel(obj['name'])
-            channel.package = obj['package']
-            for ent in obj['entries']:
-               tmp.append(ent['name'])
-            version = natsorted(tmp)[-1]
-            entry = next((ent for ent in obj['entries'] if ent['name'] == version), None)
-            channel.entries = [entry]
-            operator.operator_channels.append(channel)
-        elif obj['schema'] == 'olm.bundle' and obj['package'] in allowed:
-            operator = next(operator for operator in operators if operator.name == obj['package'])
-            for ent in operator.operator_channels[0].entries:
-                if obj['name'] == ent['name']:
-                    bundle = OperatorBundle(obj['name'], version)
-                    bundle.package = obj['package']
-                    bundle.image = obj['image']
-                    for relatedImage in  obj['relatedImages']:
-                        bundle.relatedImages.append(relatedImage)
-                    for property in obj['properties']:
-                        bundle.properties.append(property)
-                    operator.operator_bundles.append(bundle)
+    with run_metrics.Phase("render:" + catalog.custom_image_name):
+        rendered = GetRenderedCatalog(opm_cli_path, catalog, cdata)
+    with run_metrics.Phase("select:" + catalog.custom_image_name):
+        objects = fbc.ReadFileBasedCatalog(rendered)
+        operators = SelectFileBasedCatalogObjects(objects, catalog.operators)
     # GetFileBasedImageListToMirror(operators)
-    os.remove(cdata)
+    if rendered == cdata:
+        os.remove(cdata)
     print(f"writing index.json")
     with open(pdata, 'a') as index:
         for operator in operators:
@@ -456,236 +947,796 @@ def PruneFileBasedCatalog(opm_cli_path, operators, run_temp):
                 index.write(json.dumps(bund, indent=2))
     dockerfile_cmd = f"{opm_cli_path} generate dockerfile {configs_path}"
     print(f"Running '{dockerfile_cmd}'")
-    subprocess.run(dockerfile_cmd, shell=True, check=True, capture_output=True)
-    os.chdir(prune_path)
-    build_cmd = f"podman build -t {custom_redhat_operators_catalog_image_url} -f configs.Dockerfile"
+    pipeline.Run(dockerfile_cmd, prefix=f"[{catalog.custom_image_name}] ")
+    # The image build and push only depend on the pruned configs, main runs them
+    # alongside image mirroring through BuildAndPushCatalog
+    catalog.build_path = prune_path
+    return operators
+
+
+# Build the pruned file based catalog image and push it to the catalog registry
+async def BuildAndPushCatalog(catalog, journal=None):
+    with run_metrics.Phase("build-push:" + catalog.custom_image_name):
+        await BuildAndPushCatalogImage(catalog)
+    if journal is not None:
+        journal.MarkCatalog(catalog.custom_image_name, "done")
+
+
+async def BuildAndPushCatalogImage(catalog):
+    prefix = f"[{catalog.custom_image_name}] "
+    build_cmd = f"podman build -t {catalog.custom_catalog_image_url} -f configs.Dockerfile"
     print(f"Running '{build_cmd}'")
     try:
-        build_data = subprocess.run(build_cmd, shell=True, check=True, capture_output=True)
+        await pipeline.RunCommand(build_cmd, cwd=catalog.build_path, prefix=prefix)
     except subprocess.CalledProcessError:
-        print(build_data.stderr.decode('utf-8').strip())
-    except:
         print("Something went wrong building, bailing...")
-    print(build_data.stdout.decode('utf-8').strip())
-    push_cmd = f"podman push {custom_redhat_operators_catalog_image_url} --tls-verify=false --authfile {args.authfile}"
+        raise
+    push_cmd = GetCatalogPushCommand(catalog)
 
-    print(f"Pushing custom catalogue {custom_redhat_operators_catalog_image_url} to registry...")
+    print(f"Pushing custom catalogue {catalog.custom_catalog_image_url} to registry...")
     print(f"Running '{push_cmd}'")
     try:
-        push_data = subprocess.run(push_cmd, shell=True, check=True, capture_output=True)
-    except subprocess.CalledProcessError as e:
+        await pipeline.RunCommand(push_cmd, prefix=prefix)
+    except subprocess.CalledProcessError:
         print("Something went wrong pushing (auth?), bailing...")
-        exit(1)
-    print(push_data.stdout.decode('utf-8').strip())
-    os.chdir(script_root_dir)
-    return operators
+        raise
+    print(f"Finished push of {catalog.custom_catalog_image_url}")
+
+# Render the index image, reusing an earlier render of the same index digest when there is one.
+# Returns the path of the rendered catalog.
+def GetRenderedCatalog(opm_cli_path, catalog, cdata):
+    index_digest = None
+    if args.render_cache_max_entries > 0:
+        index_digest = GetImageDigest(catalog.index_image_url, args.authfile)
+    if index_digest is None:
+        render_command = f"{opm_cli_path} render {catalog.index_image_url}"
+        if not os.path.exists(cdata):
+            print(f"Running: '{render_command}'")
+            with open(cdata, 'w') as out:
+                subprocess.run(render_command, shell=True, check=True, stdout=out)
+        return cdata
+
+    render_cache = cache.RenderCache(os.path.join(cache_root_dir, "renders"),
+        int(args.render_cache_max_size * 1024 ** 3), args.render_cache_max_entries)
+    # Render by digest so the cache entry matches exactly what was rendered
+    render_command = f"{opm_cli_path} render {catalog.catalog_image_url}@{index_digest}"
+
+    def Render(out):
+        print(f"Running: '{render_command}'")
+        subprocess.run(render_command, shell=True, check=True, stdout=out)
+
+    rendered, cached = render_cache.Fetch(index_digest, Render)
+    if cached:
+        print(f"Using cached render of {catalog.index_image_url} ({index_digest})")
+        run_metrics.Count("render-cache-hit")
+    return rendered
 
-# Create a custom catalogue with selected operators from older sqlite3 based catalog
-def PruneSqliteBasedCatalog(opm_cli_path, operators, run_temp):
-  if args.authfile:
-      # Copy to correct folder for opm
-      HOME = os.getenv('HOME')
-      docker_cfg =  os.path.join(HOME, ".docker", "config.json")
-      shutil.copyfile(args.authfile, docker_cfg)
-  else:
-      print("You must pass an auth file with the '--authfile' option")
-      exit(1)
 
-  operator_list = GetListOfCommaDelimitedOperatorList(operators)
-  cmd = f"{opm_cli_path} index prune -f {redhat_operators_catalog_image_url}"
+# Resolve an image reference to its manifest digest, None if it can not be inspected
+def GetImageDigest(image_url, authfile=None):
+    if registry_client is not None:
+        try:
+            return registry_client.ManifestDigest(image_url)
+        except (registryclient.RegistryError, OSError, ValueError) as exc:
+            print("Unable to resolve the digest of " + image_url + ", not using the render cache")
+            print(exc)
+            return None
+    cmd_args = args.skopeo_path + " inspect --format '{{.Digest}}'"
+    if authfile:
+        cmd_args += " --authfile " + authfile
+    cmd_args += " docker://" + image_url
+    result = subprocess.run(cmd_args, shell=True, capture_output=True)
+    digest = result.stdout.decode('utf-8').strip()
+    if result.returncode != 0 or not digest.startswith("sha256:"):
+        print("Unable to resolve the digest of " + image_url + ", not using the render cache")
+        return None
+    return digest
+
+
+# Pick the allowed packages, their default channel and the bundles to mirror out of a
+# stream of FBC objects. Works in a single pass whatever order the objects arrive in.
+# Operators without a start_version only keep the channel head, the others keep the
+# bundles on the shortest upgrade path from start_version to the head.
+def SelectFileBasedCatalogObjects(objects, operators):
+    start_versions = {operator.name: operator.start_version for operator in operators}
+    packages = {}
+    channels = {}
+    wanted_bundles = {}
+    bundles = {}
+    for obj in objects:
+        schema = obj.get('schema')
+        if schema == 'olm.package':
+            if obj['name'] in start_versions:
+                packages[obj['name']] = obj
+                channel = channels.get((obj['name'], obj['defaultChannel']))
+                if channel is not None:
+                    SetWantedBundles(obj['name'], channel, wanted_bundles, bundles)
+        elif schema == 'olm.channel':
+            if obj['package'] in start_versions and obj['entries']:
+                if not start_versions[obj['package']]:
+                    obj = {'name': obj['name'], 'package': obj['package'], 'entries': [fbc.GetChannelHead(obj)]}
+                channels[(obj['package'], obj['name'])] = obj
+                package = packages.get(obj['package'])
+                if package is not None and package['defaultChannel'] == obj['name']:
+                    SetWantedBundles(obj['package'], obj, wanted_bundles, bundles)
+        elif schema == 'olm.bundle':
+            if obj['package'] in start_versions:
+                wanted = wanted_bundles.get(obj['package'])
+                if wanted is None or obj['name'] in wanted:
+                    bundles.setdefault(obj['package'], {})[obj['name']] = obj
+
+    selected = []
+    for name, package in packages.items():
+        operator = OperatorSpec(name, start_versions[name])
+        operator.defaultChannel = package['defaultChannel']
+        operator.icon = package.get('icon', {})
+        selected.append(operator)
+        channel_obj = channels.get((name, operator.defaultChannel))
+        if channel_obj is None:
+            continue
+        package_bundles = bundles.get(name, {})
+        channel = OperatorChannel(channel_obj['name'])
+        channel.package = name
+        if operator.start_version:
+            bundle_versions = {bundle_name: fbc.GetBundleVersion(obj) for bundle_name, obj in package_bundles.items()}
+            start_name, path_entries = fbc.GetChannelUpgradePath(name, channel_obj, bundle_versions, operator.start_version)
+            channel.entries = fbc.GetUpgradePathEntries(start_name, path_entries)
+        else:
+            channel.entries = [fbc.GetChannelHead(channel_obj)]
+        operator.operator_channels.append(channel)
+        for entry in channel.entries:
+            obj = package_bundles.get(entry['name'])
+            if obj is not None:
+                bundle = NewFileBasedBundle(obj)
+                operator.operator_bundles.append(bundle)
+                operator.upgrade_path.append(bundle.version)
+    return selected
+
+
+# Once a package's default channel is known, drop any bundles buffered for it that are not in it
+def SetWantedBundles(package, channel, wanted_bundles, bundles):
+    wanted = set(ent['name'] for ent in channel['entries'])
+    wanted_bundles[package] = wanted
+    buffered = bundles.get(package)
+    if buffered:
+        bundles[package] = {name: obj for name, obj in buffered.items() if name in wanted}
+
+
+def NewFileBasedBundle(obj):
+    bundle = OperatorBundle(obj['name'], fbc.GetBundleVersion(obj))
+    bundle.package = obj['package']
+    bundle.image = obj['image']
+    bundle.relatedImages.extend(obj.get('relatedImages') or [])
+    bundle.properties.extend(obj.get('properties') or [])
+    return bundle
+
+
+# Create a custom catalogue with selected operators from older sqlite3 based catalog
+def PruneSqliteBasedCatalog(opm_cli_path, catalog):
+  operator_list = GetListOfCommaDelimitedOperatorList(catalog.operators)
+  cmd = f"{opm_cli_path} index prune -f {catalog.index_image_url}"
   cmd += f" -p {operator_list}"  # local-storage-operator,cluster-logging,kubevirt-hyperconverged "
-  cmd += f" -t {custom_redhat_operators_catalog_image_url}"
+  cmd += f" -t {catalog.custom_catalog_image_url}"
   print(f"Running: {cmd}")
 
-  os.chdir(run_temp)
-  subprocess.run(cmd, shell=True, check=True)
-  generate_command = f"{opm_cli_path} generate dockerfile pruned-catalog/configs"
-
-  os.chdir(script_root_dir)
+  subprocess.run(cmd, shell=True, check=True, cwd=catalog.run_temp)
 
-  push_cmd = f"podman push {custom_redhat_operators_catalog_image_url} --tls-verify=false --authfile {args.authfile}"
+  push_cmd = GetCatalogPushCommand(catalog)
 
-  print(f"Pushing custom catalogue {custom_redhat_operators_catalog_image_url} to registry...")
+  print(f"Pushing custom catalogue {catalog.custom_catalog_image_url} to registry...")
   print(f"Running '{push_cmd}'")
   subprocess.run(push_cmd, shell=True, check=True)
   print("Finished push")
 
 
-def GetImageListToMirror(operators, db_path):
-  con = sqlite3.connect(db_path)
-  cur = con.cursor()
-  for operator in operators:
-    for version in operator.upgrade_path:
+# Push the locally built catalog image to the catalog registry, or into the archive with --to-dir
+def GetCatalogPushCommand(catalog):
+  if args.to_dir:
+    layout = os.path.join(args.to_dir, imagearchive.CatalogLayoutPath(catalog.custom_image_name))
+    return f"podman push {catalog.custom_catalog_image_url} oci:{layout}"
+  return f"podman push {catalog.custom_catalog_image_url} --tls-verify=false --authfile {args.authfile}"
 
-      # Get Operator bundle name
-      cmd = "select default_channel from package where name like '%" + operator.name + "%';"
 
-      result = cur.execute(cmd).fetchall()
-      if len(result) == 1:
-        channel = result[0][0]
-
-      cmd = "select operatorbundle_name from channel_entry where package_name like '" + operator.name + "' and channel_name like '" + channel + "' and operatorbundle_name like '%" + version + "%';"
-      result = cur.execute(cmd).fetchall()
+# Push a catalog image exported with --to-dir to the catalog registry
+async def PushArchivedCatalog(catalog, journal=None):
+  prefix = f"[{catalog.custom_image_name}] "
+  layout = os.path.join(args.from_dir, catalog.archive_path)
+  if args.authfile:
+    push_cmd = f"{args.skopeo_path} copy --dest-tls-verify=false --authfile {args.authfile} oci:{layout} docker://{catalog.custom_catalog_image_url}"
+  else:
+    push_cmd = f"{args.skopeo_path} copy --dest-tls-verify=false oci:{layout} docker://{catalog.custom_catalog_image_url}"
+  print(f"Pushing custom catalogue {catalog.custom_catalog_image_url} to registry...")
+  print(f"Running '{push_cmd}'")
+  with run_metrics.Phase("push:" + catalog.custom_image_name):
+    await pipeline.RunCommand(push_cmd, prefix=prefix)
+  print(f"Finished push of {catalog.custom_catalog_image_url}")
+  if journal is not None:
+    journal.MarkCatalog(catalog.custom_image_name, "done")
 
-      if len(result) > 0:
-        bundle_name = result[0][0]
 
-      bundle = OperatorBundle(bundle_name, version)
+def GetImageListToMirror(operators, catalog):
+  for operator in operators:
+    channel = catalog.GetDefaultChannel(operator.name)
+    bundles = []
+    for version in operator.upgrade_path:
+      # Get Operator bundle name
+      bundle_name = catalog.GetChannelBundle(operator.name, channel, version)
+      if bundle_name is None:
+        print("No bundle found for " + operator.name + " version " + version + " in channel " + str(channel))
+        sys.exit(1)
+      bundles.append(OperatorBundle(bundle_name, version))
+
+    # Get related images for all the operator bundles at once
+    related_images = catalog.GetRelatedImages([bundle.name for bundle in bundles])
+    for bundle in bundles:
+      bundle.relatedImages.extend(related_images[bundle.name])
+
+      # Get bundle image for operator bundle
+      bundle_path = catalog.GetBundlePath(bundle.name)
+      if bundle_path:
+        bundle.relatedImages.append(bundle_path)
 
-      # Get related images for the operator bundle
-      cmd = "select image from related_image where operatorbundle_name like '%" + bundle_name + "%';"
+      operator.operator_bundles.append(bundle)
 
-      result = cur.execute(cmd).fetchall()
-      if len(result) > 0:
-        for image in result:
-          bundle.relatedImages.append(image[0])
 
-      # Get bundle images for operator bundle
-      cmd = "select bundlepath from operatorbundle where (name like '%" +  operator.name + "%' or bundlepath like '%" +  operator.name + "%') and version='" + version + "';"
+def ExtractIndexDb(catalog, index_image_url):
+  cmd = oc_cli_path + " image extract " + index_image_url
+  cmd += " -a " + args.authfile + " --path /database/index.db:" + catalog.run_temp + " --confirm --insecure"
+  subprocess.run(cmd, shell=True, check=True)
 
-      result = cur.execute(cmd).fetchall()
-      if len(result) > 0:
-        for image in result:
-          bundle.relatedImages.append(image[0])
+  return os.path.join(catalog.run_temp, "index.db")
 
-      operator.operator_bundles.append(bundle)
 
+# With --to-dir the pruned catalog only goes into the archive, never to a
+# registry, so index.db is copied out of the image opm built in local storage
+def ExtractLocalIndexDb(catalog):
+  cmd = "podman create " + catalog.custom_catalog_image_url
+  container = subprocess.run(cmd, shell=True, check=True, stdout=subprocess.PIPE, text=True).stdout.strip().splitlines()[-1]
+  try:
+    subprocess.run("podman cp " + container + ":/database/index.db " + catalog.run_temp, shell=True, check=True)
+  finally:
+    subprocess.run("podman rm " + container, shell=True, stdout=subprocess.DEVNULL)
 
-def ExtractIndexDb():
-  cmd = oc_cli_path + " image extract " + custom_redhat_operators_catalog_image_url
-  cmd += " -a " + args.authfile + " --path /database/index.db:" + run_root_dir + " --confirm --insecure"
-  subprocess.run(cmd, shell=True, check=True)
-
-  return os.path.join(run_root_dir, "index.db")
+  return os.path.join(catalog.run_temp, "index.db")
 
 
-# Get a non duplicate list of images
+# Get a non duplicate, insertion ordered set of images
 def getImages(operators):
-  image_list = []
+  image_list = OrderedImageSet()
   for operator in operators:
     for bundle in operator.operator_bundles:
       for image in bundle.relatedImages:
         if type(image) is dict:
-            if image['image'] not in image_list:
-                image_list.append(image['image'])
+            image_list.Add(image['image'])
         else:
-            if image not in image_list:
-                image_list.append(image)
+            image_list.Add(image)
   return image_list
 
 
-def MirrorImagesToLocalRegistry(images):
+def MirrorImagesToLocalRegistry(images, journal=None):
   print("Copying image list to offline registry...")
-  failed_image_list = []
-  image_count = len(images)
-  cur_image_count = 1
+  ledger = None
+  # The ledger tracks the offline registry, an export only needs to look at the archive
+  if args.incremental_mirror.lower() == "true" and not args.to_dir:
+    ledger = mirrorstate.MirrorLedger(mirror_state_file)
+  verify_mirrored = args.verify_mirrored_images.lower() == "true"
+
+  mirror_queue = []
+  recorded = []
+  skipped_count = 0
   for image in images:
-    PrintBreakLine()
-    print(
-        "Mirroring image " +
-        str(cur_image_count) +
-        " of " +
-        str(image_count))
-    if isBadImage(image) == False:
-      destUrl = GenerateDestUrl(image)
-      max_retries = 5
-      retries = 0
-      success = False
-      while retries < max_retries and success == False:
-        if (retries > 0 ):
-          print("RETRY ATTEMPT: " +  str(retries))
-        try:
-          print("Image: " + image)
-          CopyImageToDestinationRegistry(image, destUrl, args.authfile)
-          success = True
-        except subprocess.CalledProcessError as e:
-          print("ERROR Copying image: " + image)
-          print("TO")
-          print(destUrl)
-          if (e.output is not None):
-            print("exception:" + e.output)
-          print("ERROR copying image!")
-          retries+=1
-      if not success:
-        failed_image_list.append(image)
-
+    if journal is not None and journal.IsImageDone(str(image)):
+      skipped_count += 1
+    elif args.to_dir and imagearchive.IsLayoutComplete(args.to_dir, imagearchive.ImageLayoutPath(image)):
+      skipped_count += 1
+    elif ledger is not None and ledger.IsMirrored(str(image), str(GenerateDestRef(image))):
+      recorded.append(image)
     else:
-      print("Known bad image: {}\n{}".format(image, "ignoring..."))
-
-    cur_image_count = cur_image_count + 1
-    PrintBreakLine()
+      mirror_queue.append(image)
+  missing = set()
+  if verify_mirrored and recorded:
+    missing = FindMissingMirroredImages(ledger, recorded)
+    if missing:
+      queued = set(mirror_queue) | missing
+      mirror_queue = [image for image in images if image in queued]
+  skipped_count += len(recorded) - len(missing)
+  if skipped_count > 0:
+    print("Skipping " + str(skipped_count) + " images already mirrored")
+    run_metrics.Count("already-mirrored", skipped_count)
+
+  failed_images = GetMirrorBackend(args.mirror_backend)(mirror_queue, ledger, journal)
+  if ledger is not None:
+    ledger.Save()
+  if blob_cache is not None:
+    hits = run_metrics.counters.get("blob-cache-hit-bytes", 0)
+    fetched = run_metrics.counters.get("blob-cache-fetched-bytes", 0)
+    print("Blob cache: " + str(round(hits / 1024 ** 2, 1)) + " MiB reused, " + str(round(fetched / 1024 ** 2, 1)) + " MiB fetched from upstream")
+    blob_cache.Evict()
   print("Finished mirroring related images.")
 
-  if len(failed_image_list) > 0:
+  if len(failed_images) > 0:
     print("Failed to copy the following images:")
     PrintBreakLine()
-    for image in failed_image_list:
+    for image in failed_images:
       print(image)
     PrintBreakLine()
 
 
-# Create Image Content Source Policy Yaml to apply to OCP cluster
-def CreateImageContentSourcePolicyFile(images):
+# Mirror backends copy a queue of images and return the ones that failed, in
+# queue order, after recording every image through FinishMirrorTask
+def GetMirrorBackend(name):
+  return {"skopeo": MirrorImageQueue, "skopeo-sync": SyncImageBatches, "oc": OcImageMirrorBatch}[name]
+
+
+# A single image moving through the mirror queue
+class MirrorTask:
+  def __init__(self, ref, number):
+    self.ref = ref
+    self.number = number
+    self.dest_url = str(GenerateDestRef(ref))
+    self.source, self.destination, self.copy_args = GetCopyEndpoints(ref, self.dest_url)
+    self.start = None
+    self.attempts = 0
+
+
+# Copy every image with a bounded worker pool. Workers only ever run one copy
+# attempt; retries are scheduled here with exponential backoff, and a registry
+# whose circuit breaker is open, or that is at --mirror-workers-per-registry, is
+# simply passed over so the workers keep draining the other registries.
+# Returns the images that could not be copied, in queue order.
+def MirrorImageQueue(mirror_queue, ledger=None, journal=None):
+  image_count = len(mirror_queue)
+  workers = max(1, args.mirror_workers)
+  registry_limit = args.mirror_workers_per_registry
+  policy = retrypolicy.RetryPolicy(args.mirror_max_attempts, args.mirror_retry_base_delay, args.mirror_retry_max_delay)
+
+  queues = {}
+  for index, image in enumerate(mirror_queue):
+    queues.setdefault(image.registry, deque()).append(MirrorTask(image, index + 1))
+  breakers = {registry: retrypolicy.CircuitBreaker(args.circuit_breaker_threshold, args.circuit_breaker_cooldown,
+                                                   max_probes=args.circuit_breaker_max_probes)
+              for registry in queues}
+  in_flight = dict.fromkeys(queues, 0)
+  delayed = []
+  pending = {}
+  failed = []
+  sequence = 0
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    while pending or delayed or any(queues.values()):
+      now = time.monotonic()
+      while delayed and delayed[0][0] <= now:
+        task = heapq.heappop(delayed)[2]
+        queues[task.ref.registry].appendleft(task)
+
+      # Round robin over the registries so one slow upstream can't take every worker
+      wake = delayed[0][0] if delayed else None
+      submitted = True
+      while submitted and len(pending) < workers:
+        submitted = False
+        for registry, queue in queues.items():
+          if not queue or len(pending) >= workers:
+            continue
+          if registry_limit > 0 and in_flight[registry] >= registry_limit:
+            continue
+          pause = breakers[registry].WaitTime(now)
+          if pause > 0:
+            wake = now + pause if wake is None else min(wake, now + pause)
+            continue
+          task = queue.popleft()
+          in_flight[registry] += 1
+          pending[executor.submit(MirrorImageAttempt, task, image_count)] = task
+          submitted = True
+
+      if not pending:
+        time.sleep(max(0, wake - time.monotonic()))
+        continue
+      timeout = None if wake is None else max(0, wake - time.monotonic())
+      done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+      for future in done:
+        task = pending.pop(future)
+        registry = task.ref.registry
+        in_flight[registry] -= 1
+        kind = future.result()
+        if kind is None:
+          breakers[registry].RecordSuccess()
+          FinishMirrorTask(task, True, ledger, journal)
+          continue
+        breakers[registry].RecordFailure(kind)
+        if breakers[registry].GaveUp():
+          # The registry stayed down through every probe, fail what is left of it
+          # instead of probing each remaining image through ever longer pauses
+          abandoned = [task] + list(queues[registry]) + [entry[2] for entry in delayed if entry[2].ref.registry == registry]
+          queues[registry].clear()
+          delayed = [entry for entry in delayed if entry[2].ref.registry != registry]
+          heapq.heapify(delayed)
+          print("Giving up on " + registry + " after " + str(breakers[registry].failed_probes)
+                + " failed probes, " + str(len(abandoned)) + " images not copied")
+          for abandoned_task in abandoned:
+            FinishMirrorTask(abandoned_task, False, ledger, journal)
+            failed.append(abandoned_task)
+          continue
+        if breakers[registry].IsOpen():
+          print("Pausing copies from " + registry + " for " + str(round(breakers[registry].cooldown)) + "s after repeated failures")
+        if policy.ShouldRetry(kind, task.attempts):
+          run_metrics.Count("copy-retries")
+          sequence += 1
+          heapq.heappush(delayed, (time.monotonic() + policy.Delay(task.attempts - 1), sequence, task))
+        else:
+          if kind == retrypolicy.FATAL:
+            run_metrics.Count("copy-fatal-errors")
+          FinishMirrorTask(task, False, ledger, journal)
+          failed.append(task)
+
+  trips = sum(breaker.trips for breaker in breakers.values())
+  if trips > 0:
+    run_metrics.Count("circuit-breaker-trips", trips)
+  return [str(task.ref) for task in sorted(failed, key=lambda task: task.number)]
+
+
+# One copy attempt, returns None if it succeeded or the retrypolicy classification of the failure
+def MirrorImageAttempt(task, image_count):
+  image = str(task.ref)
+  if task.start is None:
+    task.start = time.monotonic()
+    with print_lock:
+      PrintBreakLine()
+      print("Mirroring image " + str(task.number) + " of " + str(image_count))
+      print("Image: " + image)
+      PrintBreakLine()
+  else:
+    print("RETRY ATTEMPT: " + str(task.attempts) + " " + image)
+  task.attempts += 1
+  try:
+    if blob_cache is not None:
+      CopyImageThroughBlobCache(task)
+    else:
+      CopyImageToDestinationRegistry(task.source, task.destination, args.authfile, task.copy_args)
+    return None
+  except subprocess.CalledProcessError as e:
+    kind = retrypolicy.ClassifyCopyError(e.stderr)
+    with print_lock:
+      print("ERROR Copying image: " + image)
+      print("TO")
+      print(task.destination)
+      if (e.stderr is not None):
+        print("exception:" + str(e.stderr))
+      print("ERROR copying image! (" + kind + ")")
+    return kind
+  except (OSError, ValueError) as e:
+    # A missing or unreadable blob cache layout, copying again pulls it anew
+    with print_lock:
+      print("ERROR Copying image: " + image)
+      print("exception:" + repr(e))
+      print("ERROR copying image! (" + retrypolicy.RETRYABLE + ")")
+    return retrypolicy.RETRYABLE
+
+
+# skopeo sync backend, one sync per parent path of the repositories, run
+# --mirror-workers at a time
+def SyncImageBatches(mirror_queue, ledger=None, journal=None):
+  tasks = [MirrorTask(ref, index + 1) for index, ref in enumerate(mirror_queue)]
+  batches = list(mirrorbatch.GroupByParentPath(tasks, lambda task: task.ref).items())
+  os.makedirs(mirror_batch_dir, exist_ok=True)
+
+  def SyncBatch(number, parent, batch_tasks):
+    source_file = os.path.join(mirror_batch_dir, "sync-" + str(number) + ".yaml")
+    destination = args.registry_olm + "/" + parent if parent else args.registry_olm
+    def Run(refs):
+      mirrorbatch.WriteSyncSource(source_file, refs)
+      auth = " --authfile " + args.authfile if args.authfile else ""
+      cmd_args = "{} sync --src yaml --dest docker --all --keep-going --dest-tls-verify=false{} {} {}".format(
+          args.skopeo_path, auth, source_file, destination)
+      subprocess.run(cmd_args, shell=True, check=True, stderr=subprocess.PIPE, text=True)
+    return MirrorImageBatch("batch " + str(number) + " of " + str(len(batches)) + " to " + destination,
+                            batch_tasks, Run, len(tasks), ledger, journal)
+
+  failed = []
+  with ThreadPoolExecutor(max_workers=max(1, args.mirror_workers)) as executor:
+    futures = [executor.submit(SyncBatch, number + 1, parent, batch_tasks)
+               for number, (parent, batch_tasks) in enumerate(batches)]
+    for future in futures:
+      failed += future.result()
+  return [str(task.ref) for task in sorted(failed, key=lambda task: task.number)]
+
+
+# oc image mirror backend, every image in one invocation from a mapping file.
+# oc parallelises the copies itself, --max-per-registry is taken from
+# --mirror-workers-per-registry or else --mirror-workers.
+def OcImageMirrorBatch(mirror_queue, ledger=None, journal=None):
+  tasks = [MirrorTask(ref, index + 1) for index, ref in enumerate(mirror_queue)]
+  os.makedirs(mirror_batch_dir, exist_ok=True)
+  mapping = os.path.join(mirror_batch_dir, "oc-mapping.txt")
+  max_per_registry = args.mirror_workers_per_registry if args.mirror_workers_per_registry > 0 else max(1, args.mirror_workers)
+
+  def Run(refs):
+    mirrorbatch.WriteMapping(mapping, [GetOcMappingLine(ref) for ref in refs])
+    auth = " --registry-config " + args.authfile if args.authfile else ""
+    cmd_args = "{} image mirror -f {} --insecure=true --keep-manifest-list=true --filter-by-os='.*' --continue-on-error --max-per-registry {}{}".format(
+        oc_cli_path, mapping, max_per_registry, auth)
+    subprocess.run(cmd_args, shell=True, check=True, stderr=subprocess.PIPE, text=True)
+  failed = MirrorImageBatch("images with oc image mirror", tasks, Run, len(tasks), ledger, journal)
+  return [str(task.ref) for task in failed]
+
+
+# Copy a batch of images with one invocation of a bulk mirror tool. The tools
+# keep going past failed images and only report them as text, so after a failed
+# invocation each image is looked up in the destination registry and the
+# missing ones are retried one at a time with MirrorImageAttempt, each on its
+# own error and with the same backoff as single image copies. One bad image
+# neither fails nor holds up the rest of the batch. Returns the failed tasks.
+def MirrorImageBatch(name, tasks, run, image_count, ledger=None, journal=None):
+  policy = retrypolicy.RetryPolicy(args.mirror_max_attempts, args.mirror_retry_base_delay, args.mirror_retry_max_delay)
+  start = time.monotonic()
+  with print_lock:
+    PrintBreakLine()
+    print("Mirroring " + name + " (" + str(len(tasks)) + " images)")
+    PrintBreakLine()
+  for task in tasks:
+    task.start = start
+    task.attempts += 1
+  try:
+    run([task.ref for task in tasks])
+    copied, remaining = tasks, []
+  except subprocess.CalledProcessError as e:
+    with print_lock:
+      print("ERROR mirroring " + name)
+      if (e.stderr is not None):
+        print("exception:" + str(e.stderr))
+      print("ERROR copying images! (" + retrypolicy.ClassifyCopyError(e.stderr) + ")")
+    exists = DestinationImagesExist([task.dest_url for task in tasks], args.authfile)
+    copied = [task for task, found in zip(tasks, exists) if found]
+    remaining = [task for task, found in zip(tasks, exists) if not found]
+  for task in copied:
+    FinishMirrorTask(task, True, ledger, journal)
+
+  # The error of the whole invocation says nothing about a single image, so
+  # every missing image gets at least one copy of its own
+  failed = []
+  for task in remaining:
+    kind = retrypolicy.RETRYABLE
+    while kind is not None and policy.ShouldRetry(kind, task.attempts):
+      run_metrics.Count("copy-retries")
+      time.sleep(policy.Delay(task.attempts - 1))
+      kind = MirrorImageAttempt(task, image_count)
+    if kind is not None:
+      if kind == retrypolicy.FATAL:
+        run_metrics.Count("copy-fatal-errors")
+      failed.append(task)
+    FinishMirrorTask(task, kind is None, ledger, journal)
+  return failed
+
+
+# Pull into the blob cache, reusing the layers it already has, then push from there
+def CopyImageThroughBlobCache(task):
+  layout = blob_cache.LayoutPath(str(task.ref))
+  try:
+    with blob_cache.Pulling():
+      CopyImageToDestinationRegistry(task.source, "oci:" + layout, args.authfile,
+          "--dest-shared-blob-dir " + blob_cache.blob_dir)
+      cached, fetched = blob_cache.Used(layout)
+    blob_cache.Evict()
+    run_metrics.Count("blob-cache-hit-bytes", cached)
+    run_metrics.Count("blob-cache-fetched-bytes", fetched)
+    CopyImageToDestinationRegistry("oci:" + layout, task.destination, args.authfile,
+        "--src-shared-blob-dir " + blob_cache.blob_dir)
+  finally:
+    blob_cache.Release(layout)
+
+
+def FinishMirrorTask(task, success, ledger=None, journal=None):
+  image = str(task.ref)
+  if task.start is None:
+    # Failed without an attempt of its own, e.g. its registry was given up on
+    task.start = time.monotonic()
+  if success and ledger is not None:
+    ledger.Record(image, task.dest_url)
+  run_metrics.RecordImage(image, task.ref.registry, time.monotonic() - task.start, max(0, task.attempts - 1), success)
+  if journal is not None:
+    journal.MarkImage(image, "done" if success else "failed")
+
+
+# Look up images the ledger says an earlier run mirrored in the destination
+# registry, forget the ones that are gone and return them
+def FindMissingMirroredImages(ledger, refs):
+  destUrls = [str(GenerateDestRef(ref)) for ref in refs]
+  missing = set()
+  for ref, destUrl, exists in zip(refs, destUrls, DestinationImagesExist(destUrls, args.authfile)):
+    if not exists:
+      print("Image recorded as mirrored is missing from the registry: " + destUrl)
+      ledger.Forget(str(ref))
+      missing.add(ref)
+  return missing
+
+
+# Resolve every image to its manifests and write what a mirror run would transfer
+def CreateMirrorPlan(images, catalogs):
+  print("Resolving manifests of " + str(len(images)) + " images...")
+  ledger = None
+  if args.incremental_mirror.lower() == "true":
+    ledger = mirrorstate.MirrorLedger(mirror_state_file)
+  mirror_plan = mirrorplan.MirrorPlan()
+
+  def PlanImage(ref):
+    destination = str(GenerateDestRef(ref))
+    mirrored = ledger is not None and ledger.IsMirrored(str(ref), destination)
+    try:
+      digest, blobs = mirrorplan.GetImageBlobs(ref, lambda image: GetImageManifest(image, args.authfile))
+      mirror_plan.AddImage(ref, destination, digest, blobs, mirrored)
+    except (subprocess.CalledProcessError, registryclient.RegistryError, OSError, ValueError, KeyError) as exc:
+      print("Unable to resolve " + str(ref) + ": " + str(exc))
+      mirror_plan.AddImage(ref, destination, mirrored=mirrored, error=str(exc))
+
+  if registry_client is not None:
+    registry_client.Map(PlanImage, images)
+  else:
+    with ThreadPoolExecutor(max_workers=max(1, args.mirror_workers)) as executor:
+      list(executor.map(PlanImage, images))
+
+  catalog_plans = []
+  for catalog in catalogs:
+    catalog_plans.append({
+        "name": catalog.custom_image_name,
+        "index": catalog.index_image_url,
+        "custom_catalog_image": catalog.custom_catalog_image_url,
+        "operators": [{
+            "name": operator.name,
+            "start_version": operator.start_version,
+            "bundles": [{"name": bundle.name, "version": bundle.version} for bundle in operator.operator_bundles]}
+            for operator in catalog.operators]})
+  summary = mirror_plan.Write(plan_file, catalog_plans)["summary"]
+  PrintBreakLine()
+  print("Mirror plan written to " + plan_file)
+  print("Images: " + str(summary["images"]) + " (" + str(summary["images_to_copy"]) + " to copy, "
+        + str(summary["already_mirrored"]) + " already mirrored, " + str(summary["unresolved"]) + " unresolved)")
+  print("Unique repositories: " + str(summary["unique_repositories"]) + ", unique digests: " + str(summary["unique_digests"]))
+  print("Transfer: " + str(round(summary["deduplicated_bytes"] / 1024 ** 3, 2)) + " GiB de-duplicated, "
+        + str(round(summary["total_bytes"] / 1024 ** 3, 2)) + " GiB summed per image")
+  PrintBreakLine()
+
+
+# Raw manifest of a source image
+def GetImageManifest(imageUrl, authfile=None):
+  if registry_client is not None:
+    return registry_client.GetManifest(imageUrl)
+  if authfile:
+    cmd_args = "{} inspect --raw --authfile {} docker://{}".format(args.skopeo_path, authfile, imageUrl)
+  else:
+    cmd_args = "{} inspect --raw docker://{}".format(args.skopeo_path, imageUrl)
+  return subprocess.run(cmd_args, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+# Cheap manifest lookup against the destination registry
+def DestinationImageExists(destinationImageUrl, authfile=None):
+  if registry_client is not None:
+    try:
+      return registry_client.ManifestExists(destinationImageUrl)
+    except (registryclient.RegistryError, OSError) as exc:
+      print("Unable to look up " + destinationImageUrl + ": " + str(exc))
+      return False
+  if authfile:
+    cmd_args = "{} inspect --raw --tls-verify=false --authfile {} docker://{}".format(
+        args.skopeo_path, authfile, destinationImageUrl)
+  else:
+    cmd_args = "{} inspect --raw --tls-verify=false docker://{}".format(
+        args.skopeo_path, destinationImageUrl)
+  result = subprocess.run(cmd_args, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  return result.returncode == 0
+
+
+# DestinationImageExists for many images at once, concurrently
+def DestinationImagesExist(destinationImageUrls, authfile=None):
+  if registry_client is not None:
+    return registry_client.Map(lambda url: DestinationImageExists(url, authfile), destinationImageUrls)
+  with ThreadPoolExecutor(max_workers=max(1, args.mirror_workers)) as executor:
+    return list(executor.map(lambda url: DestinationImageExists(url, authfile), destinationImageUrls))
+
+
+# Create Image Content Source Policy Yaml to apply to OCP cluster. tag_sources
+# are the sources of images referenced by tag only, for the ImageTagMirrorSet
+def CreateImageContentSourcePolicyFile(sources, tag_sources=()):
   with open(image_content_source_policy_template_file) as f:
     icpt = yaml.safe_load(f)
+  name = icpt['metadata']['name']
 
-  repoList = GetRepoListToMirror(images)
+  repoList = GetRepoListToMirror(sources)
+  entries = [{'mirrors': [repoList[key]], 'source': key} for key in repoList]
 
-  for key in repoList:
-    icpt['spec']['repositoryDigestMirrors'].append(
-        {'mirrors': [repoList[key]], 'source': key})
+  if args.icsp_format in ("icsp", "both"):
+    def IcspDocument(chunk, index):
+      document = copy.deepcopy(icpt)
+      document['metadata']['name'] = PolicyDocumentName(name, index)
+      document['spec']['repositoryDigestMirrors'] = chunk
+      return document
+    WritePolicyDocuments(image_content_source_policy_output_file,
+        mirrorpolicy.SplitDocuments(entries, IcspDocument, args.icsp_max_size))
 
-  with open(image_content_source_policy_output_file, "w") as f:
-    yaml.dump(icpt, f, default_flow_style=False)
+  if args.icsp_format in ("idms", "both"):
+    WritePolicyDocuments(image_digest_mirror_set_output_file,
+        mirrorpolicy.SplitDocuments(entries, MirrorSetDocument("ImageDigestMirrorSet", "imageDigestMirrors", name), args.icsp_max_size))
+    # Digest mirror sets are ignored for pulls by tag, those need their own tag mirror set
+    if tag_sources:
+      tagList = GetRepoListToMirror(tag_sources)
+      tagEntries = [{'mirrors': [tagList[key]], 'source': key} for key in tagList]
+      WritePolicyDocuments(image_tag_mirror_set_output_file,
+          mirrorpolicy.SplitDocuments(tagEntries, MirrorSetDocument("ImageTagMirrorSet", "imageTagMirrors", name), args.icsp_max_size))
 
 
-# Get a List of repos to mirror
-def GetRepoListToMirror(images):
-  reg = r"^(.*\/){2}"
-  if args.icsp_scope == "registry":
-    reg = r"^(.*?\/){1}"
-  sourceList = []
-  mirrorList = {}
-  for image in images:
-    source = re.match(reg, image)
-    if source is None:
-      sourceRepo = image[:image.find("@")]
-    else:
-      sourceRepo = source.group()[:-1]
-    sourceList.append(
-        sourceRepo) if sourceRepo not in sourceList else sourceList
+# Document factory for ImageDigestMirrorSet and ImageTagMirrorSet
+def MirrorSetDocument(kind, field, name):
+  def Document(chunk, index):
+    return {
+        'apiVersion': 'config.openshift.io/v1',
+        'kind': kind,
+        'metadata': {'name': PolicyDocumentName(name, index)},
+        'spec': {field: chunk}}
+  return Document
+
+
+# The first document keeps the template name so small policies don't change name
+def PolicyDocumentName(name, index):
+  return name if index == 1 else name + "-" + str(index)
+
 
-  for source in sourceList:
-    mirrorList[source] = GenerateDestUrl(source)
+def WritePolicyDocuments(path, documents):
+  with atomicfile.AtomicFile(path) as f:
+    yaml.dump_all(documents, f, default_flow_style=False)
 
+
+# Mirror policy source covering an image, depending on --icsp-scope
+def GetPolicySource(image):
+  if args.icsp_scope == "registry" and image.registry:
+    return image.registry
+  return image.Namespace()
+
+
+# Get a List of repos to mirror, collapsed into the fewest covering sources
+def GetRepoListToMirror(sources):
+  mirrorList = {}
+  for sourceRepo in mirrorpolicy.AggregateSources(sources, args.icsp_max_entries):
+    mirrorList[sourceRepo] = GenerateDestUrl(sourceRepo)
   return mirrorList
 
 
-def CreateMappingFile(images):
-  repoList = GetSourceToMirrorMapping(images)
-  with open(mapping_file, "w") as f:
-    for key in repoList:
-      f.write(key + "=" + repoList[key])
-      f.write('\n')
+def GetOcMappingLine(image):
+  destination = GenerateDestRef(image)
+  return str(image) + "=" + WithoutDigest(destination.Name(), destination.tag)
 
 
-def CreateManifestFile(images):
-  with open(image_manifest_file, "w") as f:
-    for image in images:
-      f.write(image)
-      f.write("\n")
+# Mapping destinations name a repository or a tag, never a digest. In the oc
+# image mirror mapping digest pinned images are therefore pushed by digest, or
+# under the digest tag with --add-tags-to-images-mirrored-by-digest
+def WithoutDigest(name, tag):
+  return name + ":" + tag if tag else name
 
 
-def isBadImage(image):
-  with open(operator_known_bad_image_list_file, 'r') as f:
-    for bad_image in (l.rstrip('\n') for l in f):
-      if bad_image == image:
-        return True
-  return False
+# Load the bundled known-bad-images list plus any extra --known-bad-images files
+def LoadKnownBadImages():
+  deny_list = ImageDenyList()
+  for path in [operator_known_bad_image_list_file] + args.known_bad_images:
+    try:
+      deny_list.Load(path)
+    except OSError as exc:
+      print("An exception occurred while reading known bad images file " + path)
+      print(exc)
+      sys.exit(1)
+  return deny_list
+
+
+# Drop known bad images so they never reach the mirror queue or the ICSP and mapping outputs
+def RemoveKnownBadImages(images, deny_list=None):
+  if deny_list is None:
+    deny_list = LoadKnownBadImages()
+  filtered = OrderedImageSet()
+  for image in images:
+    if deny_list.Matches(image):
+      print("Known bad image: {}\n{}".format(image, "ignoring..."))
+    else:
+      filtered.Add(image)
+  return filtered
 
 
 def GenerateDestUrl(image_url):
-  print(f"{image_url}")
   res = image_url.find("/")
   if res != -1:
     GenDestUrl = args.registry_olm + image_url[res:]
@@ -698,38 +1749,44 @@ def GenerateDestUrl(image_url):
   return GenDestUrl
 
 
-def CopyImageToDestinationRegistry(
-        sourceImageUrl, destinationImageUrl, authfile=None):
-  if args.authfile:
-    cmd_args = "skopeo copy --dest-tls-verify=false --authfile {} -a docker://{} docker://{}".format(
-        authfile, sourceImageUrl, destinationImageUrl)
-  else:
-    cmd_args = "skopeo copy --dest-tls-verify=false -a docker://{} docker://{}".format(
-        sourceImageUrl, destinationImageUrl)
-  subprocess.run(cmd_args, shell=True, check=True)
+# Destination of an image in the offline registry
+def GenerateDestRef(ref):
+  if add_tags_to_images_mirrored_by_digest.lower() == "true" and ref.digest.startswith("sha256:"):
+    return ImageRef(args.registry_olm, ref.repository, ref.digest[len("sha256:"):])
+  return ref.WithRegistry(args.registry_olm)
 
 
-# Get a Mapping of source to mirror images
-def GetSourceToMirrorMapping(images):
-  reg = r"^(.*@){1}"
-  mapping = {}
-  for image in images:
-    source = re.match(reg, image)
-    if source is None:
-      sourceRepo = image
-    else:
-      sourceRepo = source.group()[:-1]
+# Source and destination of an image copy with their skopeo transports, plus
+# any extra copy arguments. Registry to registry normally, registry to the
+# archive with --to-dir and archive to registry with --from-dir; archive layouts
+# share one blob directory so layers common to several images are stored once.
+def GetCopyEndpoints(ref, dest_url):
+  if args.to_dir:
+    layout = os.path.join(args.to_dir, imagearchive.ImageLayoutPath(ref))
+    return "docker://" + str(ref), "oci:" + layout, "--dest-shared-blob-dir " + imagearchive.SharedBlobDir(args.to_dir)
+  if args.from_dir:
+    layout = os.path.join(args.from_dir, imagearchive.ImageLayoutPath(ref))
+    return "oci:" + layout, "docker://" + dest_url, "--src-shared-blob-dir " + imagearchive.SharedBlobDir(args.from_dir)
+  return "docker://" + str(ref), "docker://" + dest_url, ""
 
-    mapping[image] = GenerateDestUrl(sourceRepo)
 
-  return mapping
+def CopyImageToDestinationRegistry(
+        source, destination, authfile=None, copy_args=""):
+  if args.authfile:
+    cmd_args = "{} copy --dest-tls-verify=false --authfile {} -a {} {} {}".format(
+        args.skopeo_path, authfile, copy_args, source, destination)
+  else:
+    cmd_args = "{} copy --dest-tls-verify=false -a {} {} {}".format(
+        args.skopeo_path, copy_args, source, destination)
+  subprocess.run(cmd_args, shell=True, check=True, stderr=subprocess.PIPE, text=True)
 
 
 def CreateCatalogSourceYaml(image_url, image_name, display_name):
   with open(catalog_source_template_file, 'r') as f:
     templateFile = Template(f.read())
   content = templateFile.render(CatalogSourceImage=image_url, CatalogSourceName=image_name, CatalogSourceDisplayName=display_name)
-  with open(catalog_source_output_file, "w") as f:
+  catalog_source_output_file = os.path.join(publish_root_dir, image_name + '--catalogsource.yaml')
+  with atomicfile.AtomicFile(catalog_source_output_file) as f:
     f.write(content)
 
 
@@ -756,11 +1813,36 @@ def PrintBreakLine():
   print("----------------------------------------------")
 
 
+# One source catalog (index image and channel) and the operators to take from it
+class CatalogSpec:
+  def __init__(self, operator_image_name, catalog_image_url, operator_channel, custom_catalog_image_url, operators):
+      self.operator_image_name = operator_image_name
+      self.catalog_image_url = catalog_image_url
+      self.operator_channel = operator_channel
+      index_version = ":v" + operator_channel if is_number(operator_channel) else ":" + operator_channel
+      self.index_image_url = catalog_image_url + index_version
+      self.custom_catalog_image_url = custom_catalog_image_url
+      self.custom_image_name = "custom-" + operator_image_name
+      display_name = re.sub(r'^redhat-', 'red hat-', operator_image_name)
+      self.display_name = re.sub('-', ' ', display_name).title()
+      self.operators = operators
+      self.run_temp = ""
+      self.build_path = ""
+      self.archive_path = ""
+      self.diff_baseline = ""
+      self.baseline_images = None
+
+  # Index images from OCP 4.11 on are file based catalogs
+  def IsFileBased(self):
+      version = self.operator_channel.split('.')
+      return int(version[0]) > 3 and int(version[1]) > 10
+
+
 class OperatorSpec:
   def __init__(self, name, start_version):
       self.name = name
       self.start_version = start_version
-      self.upgrade_path = ""
+      self.upgrade_path = []
       self.operator_bundles = []
       self.operator_channels = []
       self.defaultChannel = ""
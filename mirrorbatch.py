@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import os
+import yaml
+
+
+# skopeo sync copies every repository of its source file into one destination
+# path and only keeps the last component of each repository name, so images
+# are batched by the parent path of their repository to land where skopeo copy
+# would have put them. Returns {parent path: [items]} in queue order.
+def GroupByParentPath(items, ref=lambda item: item):
+  groups = {}
+  for item in items:
+    groups.setdefault(os.path.dirname(ref(item).repository), []).append(item)
+  return groups
+
+
+# skopeo sync --src yaml source of a batch: {registry: {"images": {repository: [tag or digest]}}}.
+# An image referenced by tag and digest is copied by its digest.
+def SyncSource(refs):
+  registries = {}
+  for ref in refs:
+    images = registries.setdefault(ref.registry, {"images": {}})["images"]
+    references = images.setdefault(ref.repository, [])
+    reference = ref.digest or ref.tag or "latest"
+    if reference not in references:
+      references.append(reference)
+  return registries
+
+
+def WriteSyncSource(path, refs):
+  with open(path, "w") as f:
+    yaml.safe_dump(SyncSource(refs), f, default_flow_style=False)
+
+
+# oc image mirror -f file, one source=destination line per image
+def WriteMapping(path, lines):
+  with open(path, "w") as f:
+    for line in lines:
+      f.write(line + "\n")
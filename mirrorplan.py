@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import json
+import hashlib
+import threading
+import atomicfile
+from datetime import datetime, timezone
+
+MANIFEST_LIST_MEDIA_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json")
+
+
+# Blobs an image copy transfers, {digest: size}, including the manifests
+# themselves. fetch_manifest(reference) returns the raw manifest bytes; manifest
+# lists are followed into every platform because skopeo copy -a copies them all.
+# Returns (manifest digest, blobs); sizes are None for schema 1 manifests.
+def GetImageBlobs(ref, fetch_manifest):
+  raw = fetch_manifest(str(ref))
+  digest = "sha256:" + hashlib.sha256(raw).hexdigest()
+  blobs = {digest: len(raw)}
+  manifest = json.loads(raw)
+  manifests = [manifest]
+  if manifest.get("mediaType") in MANIFEST_LIST_MEDIA_TYPES or "manifests" in manifest:
+    manifests = []
+    for entry in manifest.get("manifests", []):
+      blobs[entry["digest"]] = entry.get("size")
+      manifests.append(json.loads(fetch_manifest(ref.Name() + "@" + entry["digest"])))
+  for manifest in manifests:
+    if "fsLayers" in manifest:
+      for layer in manifest["fsLayers"]:
+        blobs.setdefault(layer["blobSum"], None)
+      continue
+    if "config" in manifest:
+      blobs[manifest["config"]["digest"]] = manifest["config"].get("size")
+    for layer in manifest.get("layers", []):
+      blobs[layer["digest"]] = layer.get("size")
+  return digest, blobs
+
+
+# What a mirror run would do: every image with its destination, manifest digest
+# and size, and totals with layers shared between images counted once
+class MirrorPlan:
+  def __init__(self):
+    self.images = []
+    self.blobs = {}
+    self.lock = threading.Lock()
+
+  def AddImage(self, ref, destination, digest=None, blobs=None, mirrored=False, error=None):
+    entry = {"image": str(ref), "repository": ref.Name(), "destination": destination, "digest": digest,
+             "already_mirrored": mirrored}
+    if blobs is not None:
+      sizes = [size for size in blobs.values() if size is not None]
+      entry["blobs"] = len(blobs)
+      entry["bytes"] = sum(sizes)
+      entry["size_known"] = len(sizes) == len(blobs)
+    if error is not None:
+      entry["error"] = error
+    with self.lock:
+      self.images.append(entry)
+      if blobs is not None and not mirrored:
+        for blob, size in blobs.items():
+          self.blobs.setdefault(blob, size)
+
+  def Summary(self):
+    with self.lock:
+      images = list(self.images)
+      blobs = dict(self.blobs)
+    to_copy = [image for image in images if not image["already_mirrored"]]
+    return {
+        "images": len(images),
+        "images_to_copy": len(to_copy),
+        "already_mirrored": len(images) - len(to_copy),
+        "unresolved": sum(1 for image in images if "error" in image),
+        "unique_repositories": len(set(image["repository"] for image in images)),
+        "unique_digests": len(set(image["digest"] for image in images if image["digest"])),
+        "unique_blobs": len(blobs),
+        "total_bytes": sum(image.get("bytes", 0) for image in to_copy),
+        "deduplicated_bytes": sum(size for size in blobs.values() if size is not None),
+        "blobs_of_unknown_size": sum(1 for size in blobs.values() if size is None)}
+
+  # catalogs: [{"name", "index", "operators": [...]}] as built by the caller
+  def Write(self, path, catalogs):
+    plan = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "summary": self.Summary(),
+        "catalogs": catalogs,
+        "images": sorted(self.images, key=lambda image: image["image"])}
+    with atomicfile.AtomicFile(path) as f:
+      json.dump(plan, f, indent=2)
+    return plan
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import yaml
+
+
+class TrieNode:
+  __slots__ = ("children", "terminal")
+
+  def __init__(self):
+    self.children = {}
+    self.terminal = False
+
+
+# Trie over repository paths split on "/", the first level being the registry.
+# A source in a mirror policy matches every repository below it, so a terminal
+# node covers its whole subtree and anything inserted below it is redundant.
+class RepositoryTrie:
+  def __init__(self):
+    self.root = TrieNode()
+
+  def Insert(self, source):
+    node = self.root
+    for part in source.split("/"):
+      node = node.children.setdefault(part, TrieNode())
+    node.terminal = True
+
+  # The fewest terminal paths covering everything inserted, as [(path parts, node)]
+  def Covering(self):
+    covering = []
+    stack = [((), self.root)]
+    while stack:
+      parts, node = stack.pop()
+      if node.terminal:
+        covering.append((parts, node))
+        continue
+      for part, child in node.children.items():
+        stack.append((parts + (part,), child))
+    return covering
+
+  def Node(self, parts):
+    node = self.root
+    for part in parts:
+      node = node.children[part]
+    return node
+
+
+# Collapse repository sources into the fewest prefixes that cover them. Sources
+# nested below another source are always dropped. With max_entries the sources
+# are then merged into their parent path, the parent covering most sources first
+# and the deepest on a tie, until there are at most max_entries or only
+# registries are left.
+def AggregateSources(sources, max_entries=0):
+  trie = RepositoryTrie()
+  for source in sources:
+    trie.Insert(source)
+  covering = trie.Covering()
+  while max_entries > 0 and len(covering) > max_entries:
+    parents = {}
+    for parts, _ in covering:
+      if len(parts) > 1:
+        parents[parts[:-1]] = parents.get(parts[:-1], 0) + 1
+    if not parents:
+      break
+    best = max(parents, key=lambda parts: (parents[parts], len(parts)))
+    trie.Node(best).terminal = True
+    covering = trie.Covering()
+  return sorted("/".join(parts) for parts, _ in covering)
+
+
+# Split mirror entries over as many documents as needed to keep each serialized
+# document under max_bytes. make_document(entries, index) builds document index
+# (1 based) for a slice of the entries. 0 disables splitting. Entries of a block
+# list serialize independently, so each one is measured once on its own; in the
+# document the list sits under spec, which indents each of its lines by two.
+def SplitDocuments(entries, make_document, max_bytes=0):
+  if max_bytes <= 0:
+    return [make_document(entries, 1)]
+  base_size = len(yaml.dump(make_document([], 1)))
+  chunks = [[]]
+  size = base_size
+  for entry in entries:
+    text = yaml.dump([entry], default_flow_style=False)
+    entry_size = len(text) + 2 * text.count("\n")
+    if chunks[-1] and size + entry_size > max_bytes:
+      chunks.append([])
+      size = base_size
+    chunks[-1].append(entry)
+    size += entry_size
+  return [make_document(chunk, index + 1) for index, chunk in enumerate(chunks)]
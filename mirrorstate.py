@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+import os
+import json
+import threading
+import atomicfile
+from datetime import datetime, timezone
+
+
+# Only digest pinned references are immutable, anything else can move under us
+def IsDigestReference(image):
+  return "@sha256:" in image
+
+
+# Persistent record of which source digests have landed at which destination
+class MirrorLedger:
+  def __init__(self, path, save_interval=25):
+    self.path = path
+    self.save_interval = save_interval
+    self.images = {}
+    self.unsaved = 0
+    self.lock = threading.Lock()
+    self.Load()
+
+  def Load(self):
+    if not os.path.exists(self.path):
+      return
+    try:
+      with open(self.path) as f:
+        data = json.load(f)
+      self.images = data.get("images", {})
+    except (ValueError, OSError) as exc:
+      print("Ignoring unreadable mirror state file " + self.path)
+      print(exc)
+      self.images = {}
+
+  def IsMirrored(self, source, destination):
+    if not IsDigestReference(source):
+      return False
+    with self.lock:
+      entry = self.images.get(source)
+    return entry is not None and entry["destination"] == destination
+
+  def Record(self, source, destination):
+    if not IsDigestReference(source):
+      return
+    with self.lock:
+      self.images[source] = {
+          "destination": destination,
+          "mirrored": datetime.now(timezone.utc).isoformat()}
+      self.unsaved += 1
+      if self.unsaved >= self.save_interval:
+        self._Write()
+
+  def Forget(self, source):
+    with self.lock:
+      if self.images.pop(source, None) is not None:
+        self.unsaved += 1
+
+  def Save(self):
+    with self.lock:
+      self._Write()
+
+  # Write to a temp file and rename so a crash never leaves a truncated ledger
+  def _Write(self):
+    with atomicfile.AtomicFile(self.path) as f:
+      json.dump({"version": 1, "images": self.images}, f, indent=2, sort_keys=True)
+    self.unsaved = 0
+
+
+# Crash safe journal of a mirror run. The first record is a snapshot of the
+# catalogs and images the run works on, every later record is a state change
+# (pending/done/failed) of one image or catalog build. Records are appended and
+# fsync'd one at a time, so after a crash the journal says exactly what is left.
+class MirrorJournal:
+  def __init__(self, path):
+    self.path = path
+    self.snapshot = None
+    self.images = {}
+    self.catalogs = {}
+    self.complete = False
+    self.lock = threading.Lock()
+    self.file = None
+    # Bytes of whole records read by Load, None for a journal this run wrote
+    self.valid_size = None
+
+  # Read an existing journal, returns False if there is nothing to resume
+  def Load(self):
+    if not os.path.exists(self.path):
+      return False
+    self.valid_size = 0
+    with open(self.path, "rb") as f:
+      for line in f:
+        # A record cut off before its newline can still parse, but the next
+        # append would join it, so only whole lines count. A torn last line
+        # is from a crash mid write, everything before it is intact.
+        if not line.endswith(b"\n"):
+          break
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        self.valid_size += len(line)
+        if record["type"] == "snapshot":
+          self.snapshot = record
+          self.images = {image: "pending" for image in record.get("mirror_images", record["images"])}
+          self.catalogs = {catalog["name"]: "pending" for catalog in record["catalogs"]}
+        elif record["type"] == "image":
+          self.images[record["image"]] = record["state"]
+        elif record["type"] == "catalog":
+          self.catalogs[record["name"]] = record["state"]
+        elif record["type"] == "complete":
+          self.complete = True
+    return self.snapshot is not None and not self.complete
+
+  # Begin a new run, replacing any previous journal. mirror_images is the part
+  # of images that gets copied when it is not all of them
+  def Start(self, catalogs, images, mirror_images=None):
+    self.snapshot = {
+        "type": "snapshot",
+        "started": datetime.now(timezone.utc).isoformat(),
+        "catalogs": catalogs,
+        "images": images}
+    if mirror_images is not None:
+      self.snapshot["mirror_images"] = mirror_images
+    else:
+      mirror_images = images
+    self.images = {image: "pending" for image in mirror_images}
+    self.catalogs = {catalog["name"]: "pending" for catalog in catalogs}
+    self.complete = False
+    self.valid_size = None
+    with atomicfile.AtomicFile(self.path) as f:
+      f.write(json.dumps(self.snapshot) + "\n")
+    self.Open()
+
+  # Continue appending to a loaded journal
+  def Open(self):
+    self.file = open(self.path, "a")
+    if self.valid_size is not None:
+      # Drop a torn record so the next one starts on its own line
+      self.file.truncate(self.valid_size)
+
+  def Close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+
+  def _Append(self, record):
+    with self.lock:
+      self.file.write(json.dumps(record) + "\n")
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def MarkImage(self, image, state):
+    self.images[image] = state
+    self._Append({"type": "image", "image": image, "state": state})
+
+  def MarkCatalog(self, name, state):
+    self.catalogs[name] = state
+    self._Append({"type": "catalog", "name": name, "state": state})
+
+  def MarkComplete(self):
+    self.complete = True
+    self._Append({"type": "complete"})
+
+  def IsImageDone(self, image):
+    return self.images.get(image) == "done"
+
+  def IsCatalogDone(self, name):
+    return self.catalogs.get(name) == "done"
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import sys
+import asyncio
+import subprocess
+
+
+# Copy lines from a child stream as they arrive instead of buffering the whole output
+async def StreamLines(stream, out, prefix):
+  while True:
+    line = await stream.readline()
+    if not line:
+      break
+    out.write(prefix + line.decode("utf-8", errors="replace"))
+    out.flush()
+
+
+# Run a shell command, streaming its stdout and stderr with a prefix on every line.
+# Raises subprocess.CalledProcessError on a non zero exit when check is set.
+async def RunCommand(cmd, cwd=None, prefix="", check=True):
+  process = await asyncio.create_subprocess_shell(
+      cmd, cwd=cwd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+  await asyncio.gather(
+      StreamLines(process.stdout, sys.stdout, prefix),
+      StreamLines(process.stderr, sys.stderr, prefix))
+  returncode = await process.wait()
+  if check and returncode != 0:
+    raise subprocess.CalledProcessError(returncode, cmd)
+  return returncode
+
+
+# Blocking form of RunCommand for code that is not running in an event loop
+def Run(cmd, cwd=None, prefix="", check=True):
+  return asyncio.run(RunCommand(cmd, cwd, prefix, check))
+
+
+# Run independent pipeline stages side by side. Coroutines run on the event loop,
+# plain callables (blocking work such as the image mirror thread pool) run in a
+# worker thread. Every stage runs to completion; the exceptions are returned in
+# stage order, None for the stages that succeeded.
+async def RunStages(stages):
+  tasks = []
+  for stage in stages:
+    if asyncio.iscoroutine(stage):
+      tasks.append(stage)
+    else:
+      tasks.append(asyncio.get_running_loop().run_in_executor(None, stage))
+  results = await asyncio.gather(*tasks, return_exceptions=True)
+  return [result if isinstance(result, BaseException) else None for result in results]
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+import os
+import re
+import ssl
+import json
+import time
+import hashlib
+import threading
+import http.client
+import urllib.parse
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from imageref import ParseImageRef
+
+MANIFEST_MEDIA_TYPES = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.v1+prettyjws"])
+# Registries whose API is served from another host than the one in image names
+REGISTRY_HOSTS = {"docker.io": "registry-1.docker.io"}
+# Where skopeo and podman look for credentials when no --authfile is given
+DEFAULT_AUTH_FILES = [
+    os.path.join(os.getenv("XDG_RUNTIME_DIR", "/run/user/" + str(os.getuid())), "containers", "auth.json"),
+    os.path.join(os.path.expanduser("~"), ".docker", "config.json")]
+# Connection errors after which a request is sent again on a fresh connection,
+# a pooled keep-alive connection may have been closed by the registry meanwhile
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                           ConnectionResetError, BrokenPipeError)
+TOKEN_EXPIRY_MARGIN = 10
+
+
+class RegistryError(Exception):
+  def __init__(self, message, status=None):
+    super().__init__(message)
+    self.status = status
+
+
+# {key: base64 "user:password"} of a containers-auth.json or docker config.json.
+# Keys are a registry, or registry/namespace for credentials limited to it.
+def LoadAuthFile(path):
+  if not path:
+    path = next((candidate for candidate in DEFAULT_AUTH_FILES if os.path.exists(candidate)), None)
+    if path is None:
+      return {}
+  with open(path) as f:
+    auths = json.load(f).get("auths", {})
+  credentials = {}
+  for key, entry in auths.items():
+    if entry.get("auth"):
+      credentials[re.sub(r"^https?://", "", key).rstrip("/")] = entry["auth"]
+  return credentials
+
+
+# Parameters of a WWW-Authenticate challenge as (scheme, {name: value})
+def ParseChallenge(header):
+  scheme, _, params = header.partition(" ")
+  return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+
+# Keep-alive connections to one host, at most size of them open at a time
+class ConnectionPool:
+  def __init__(self, scheme, host, size, timeout, verify=True):
+    self.scheme = scheme
+    self.host = host
+    self.timeout = timeout
+    self.verify = verify
+    self.idle = []
+    self.lock = threading.Lock()
+    self.slots = threading.BoundedSemaphore(size)
+
+  def NewConnection(self):
+    if self.scheme == "http":
+      return http.client.HTTPConnection(self.host, timeout=self.timeout)
+    context = ssl.create_default_context()
+    if not self.verify:
+      context.check_hostname = False
+      context.verify_mode = ssl.CERT_NONE
+    return http.client.HTTPSConnection(self.host, timeout=self.timeout, context=context)
+
+  # A connection that is handed back to the pool unless the request failed on it
+  @contextmanager
+  def Connection(self, fresh=False):
+    self.slots.acquire()
+    connection = None
+    try:
+      with self.lock:
+        if self.idle and not fresh:
+          connection = self.idle.pop()
+      if connection is None:
+        connection = self.NewConnection()
+      yield connection
+      with self.lock:
+        self.idle.append(connection)
+      connection = None
+    finally:
+      if connection is not None:
+        connection.close()
+      self.slots.release()
+
+  def Close(self):
+    with self.lock:
+      for connection in self.idle:
+        connection.close()
+      self.idle = []
+
+
+# Minimal OCI distribution (registry v2) client for manifest lookups. It keeps
+# a pool of keep-alive connections per host and caches bearer tokens per
+# repository until they expire, so checking thousands of images costs one TLS
+# handshake per connection and one token request per repository. The auth
+# scheme of a registry is learnt from its first 401 and used up front after.
+class RegistryClient:
+  def __init__(self, authfile=None, connections=8, insecure=(), timeout=30):
+    self.authfile = authfile
+    self.connections = connections
+    self.insecure = set(insecure)
+    self.timeout = timeout
+    self.credentials = None
+    self.pools = {}
+    self.schemes = {}
+    self.challenges = {}
+    self.tokens = {}
+    self.lock = threading.Lock()
+
+  def Credentials(self, registry, repository):
+    with self.lock:
+      if self.credentials is None:
+        self.credentials = LoadAuthFile(self.authfile)
+    parts = (registry + "/" + repository).split("/")
+    while parts:
+      auth = self.credentials.get("/".join(parts))
+      if auth:
+        return auth
+      parts.pop()
+    return None
+
+  def Pool(self, scheme, host):
+    with self.lock:
+      pool = self.pools.get((scheme, host))
+      if pool is None:
+        pool = ConnectionPool(scheme, host, self.connections, self.timeout, host not in self.insecure)
+        self.pools[(scheme, host)] = pool
+      return pool
+
+  # One HTTP request on a pooled connection, returns (status, headers, body).
+  # Protocol errors such as a truncated response raise RegistryError.
+  def Send(self, scheme, host, method, path, headers):
+    pool = self.Pool(scheme, host)
+    for fresh in (False, True):
+      try:
+        with pool.Connection(fresh) as connection:
+          connection.request(method, path, headers=headers)
+          response = connection.getresponse()
+          body = response.read()
+          return response.status, response.headers, body
+      except STALE_CONNECTION_ERRORS + (http.client.HTTPException,) as exc:
+        if fresh or not isinstance(exc, STALE_CONNECTION_ERRORS):
+          raise RegistryError(method + " " + host + path + " failed: " + type(exc).__name__ + " " + str(exc)) from exc
+
+  # Insecure registries are tried over https without verification first and
+  # fall back to plain http, like skopeo --tls-verify=false
+  def SendToRegistry(self, host, method, path, headers):
+    scheme = self.schemes.get(host, "https")
+    try:
+      return self.Send(scheme, host, method, path, headers)
+    except ssl.SSLError:
+      if host not in self.insecure or scheme == "http":
+        raise
+      self.schemes[host] = "http"
+      return self.Send("http", host, method, path, headers)
+
+  # The challenge is kept per registry, so the scope it names is that of the
+  # repository that got it; the scope is always built for this repository
+  def Token(self, registry, repository, params, refresh=False):
+    scope = "repository:" + repository + ":pull"
+    key = (registry, scope)
+    now = time.monotonic()
+    with self.lock:
+      cached = self.tokens.get(key)
+    if cached is not None and cached[1] > now and not refresh:
+      return cached[0]
+    realm = urllib.parse.urlsplit(params.get("realm", ""))
+    if not realm.netloc:
+      raise RegistryError("Bad token realm from " + registry + ": " + params.get("realm", ""))
+    query = {"scope": scope}
+    if params.get("service"):
+      query["service"] = params["service"]
+    path = (realm.path or "/") + "?" + urllib.parse.urlencode(query)
+    headers = {}
+    auth = self.Credentials(registry, repository)
+    if auth:
+      headers["Authorization"] = "Basic " + auth
+    status, _, body = self.Send(realm.scheme or "https", realm.netloc, "GET", path, headers)
+    if status != 200:
+      raise RegistryError("Token request for " + registry + "/" + repository + " failed with HTTP " + str(status), status)
+    response = json.loads(body)
+    token = response.get("token") or response.get("access_token")
+    if not token:
+      raise RegistryError("No token in the response of " + realm.netloc)
+    with self.lock:
+      self.tokens[key] = (token, now + response.get("expires_in", 60) - TOKEN_EXPIRY_MARGIN)
+    return token
+
+  def Authorization(self, registry, repository, refresh=False):
+    challenge = self.challenges.get(registry)
+    if challenge is None:
+      return None
+    scheme, params = challenge
+    if scheme == "bearer":
+      return "Bearer " + self.Token(registry, repository, params, refresh)
+    if scheme == "basic":
+      auth = self.Credentials(registry, repository)
+      return "Basic " + auth if auth else None
+    return None
+
+  # Manifest request for an image, authenticating and retrying once on a 401
+  def ManifestRequest(self, method, image):
+    ref = ParseImageRef(image)
+    if not ref.registry:
+      raise RegistryError("No registry in image reference " + str(image))
+    host = REGISTRY_HOSTS.get(ref.registry, ref.registry)
+    path = "/v2/" + ref.repository + "/manifests/" + (ref.digest or ref.tag or "latest")
+    headers = {"Accept": MANIFEST_MEDIA_TYPES}
+    auth = self.Authorization(ref.registry, ref.repository)
+    if auth:
+      headers["Authorization"] = auth
+    status, response_headers, body = self.SendToRegistry(host, method, path, headers)
+    if status == 401 and response_headers.get("WWW-Authenticate"):
+      self.challenges[ref.registry] = ParseChallenge(response_headers["WWW-Authenticate"])
+      auth = self.Authorization(ref.registry, ref.repository, refresh=True)
+      if auth:
+        headers["Authorization"] = auth
+        status, response_headers, body = self.SendToRegistry(host, method, path, headers)
+    return status, response_headers, body
+
+  def ManifestExists(self, image):
+    status, _, _ = self.ManifestRequest("HEAD", image)
+    if status == 200:
+      return True
+    if status == 404:
+      return False
+    raise RegistryError("Manifest lookup of " + str(image) + " failed with HTTP " + str(status), status)
+
+  # Raw manifest bytes, exactly as the registry stores them
+  def GetManifest(self, image):
+    status, _, body = self.ManifestRequest("GET", image)
+    if status != 200:
+      raise RegistryError("Manifest fetch of " + str(image) + " failed with HTTP " + str(status), status)
+    return body
+
+  # Digest of the manifest (or manifest list) an image reference points at
+  def ManifestDigest(self, image):
+    status, headers, _ = self.ManifestRequest("HEAD", image)
+    if status != 200:
+      raise RegistryError("Manifest lookup of " + str(image) + " failed with HTTP " + str(status), status)
+    digest = headers.get("Docker-Content-Digest")
+    if digest:
+      return digest
+    return "sha256:" + hashlib.sha256(self.GetManifest(image)).hexdigest()
+
+  # Apply function to every image concurrently, enough threads to use every
+  # pooled connection of each registry. Results are in the order of images.
+  def Map(self, function, images):
+    images = list(images)
+    if not images:
+      return []
+    registries = set(ParseImageRef(image).registry for image in images)
+    with ThreadPoolExecutor(max_workers=self.connections * len(registries)) as executor:
+      return list(executor.map(function, images))
+
+  def Close(self):
+    with self.lock:
+      pools = list(self.pools.values())
+    for pool in pools:
+      pool.Close()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+import re
+import time
+import random
+
+RETRYABLE = "retryable"
+THROTTLED = "throttled"
+FATAL = "fatal"
+
+# skopeo has no machine readable error codes, so the failure is classified from
+# its stderr. Errors the registry will answer the same way every time are fatal,
+# rate limiting trips the registry's circuit breaker right away, anything else
+# (5xx, timeouts, dropped connections, unknown errors) is retried with backoff.
+FATAL_PATTERNS = re.compile(
+    r"unauthorized|authentication required|denied|forbidden|manifest unknown|"
+    r"name unknown|not found|invalid reference format|no such image|"
+    r"does not match digest|manifest list not supported",
+    re.IGNORECASE)
+THROTTLED_PATTERNS = re.compile(r"toomanyrequests|too many requests|\b429\b|rate limit", re.IGNORECASE)
+
+
+def ClassifyCopyError(output):
+  if not output:
+    return RETRYABLE
+  if THROTTLED_PATTERNS.search(output):
+    return THROTTLED
+  if FATAL_PATTERNS.search(output):
+    return FATAL
+  return RETRYABLE
+
+
+# Exponential backoff with full jitter: attempt n waits a random time between 0
+# and min(max_delay, base_delay * 2^n), so retries from many workers spread out
+# instead of arriving at the registry together.
+class RetryPolicy:
+  def __init__(self, max_attempts=5, base_delay=2.0, max_delay=60.0):
+    self.max_attempts = max_attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+
+  def ShouldRetry(self, kind, attempts):
+    return kind != FATAL and attempts < self.max_attempts
+
+  def Delay(self, retries):
+    return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retries)))
+
+
+# Per registry circuit breaker. After `threshold` consecutive retryable failures,
+# or any throttling response, the registry is left alone for `cooldown` seconds.
+# Then a single probe copy is let through: success closes the breaker, failure
+# opens it again for twice as long (up to max_cooldown). After max_probes
+# consecutive failed probes the registry is given up on (0 never gives up).
+class CircuitBreaker:
+  def __init__(self, threshold=5, cooldown=30.0, max_cooldown=600.0, max_probes=3):
+    self.threshold = threshold
+    self.max_probes = max_probes
+    self.failed_probes = 0
+    self.base_cooldown = cooldown
+    self.cooldown = cooldown
+    self.max_cooldown = max_cooldown
+    self.failures = 0
+    self.open_until = 0.0
+    self.probing = False
+    self.trips = 0
+
+  # Seconds until a copy may be started, 0 if it may start now
+  def WaitTime(self, now=None):
+    if now is None:
+      now = time.monotonic()
+    if self.probing:
+      return max(1.0, self.open_until - now)
+    if now < self.open_until:
+      return self.open_until - now
+    if self.failures >= self.threshold:
+      self.probing = True
+      self.open_until = now + self.cooldown
+    return 0
+
+  def RecordSuccess(self):
+    self.failures = 0
+    self.failed_probes = 0
+    self.probing = False
+    self.open_until = 0.0
+    self.cooldown = self.base_cooldown
+
+  def RecordFailure(self, kind, now=None):
+    if kind == FATAL:
+      # The registry answered, it is the image that is broken
+      self.RecordSuccess()
+      return
+    if now is None:
+      now = time.monotonic()
+    self.failures += 1
+    if kind == THROTTLED:
+      self.failures = max(self.failures, self.threshold)
+    if self.probing or self.failures >= self.threshold:
+      if self.probing:
+        self.failed_probes += 1
+        self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+      self.probing = False
+      self.open_until = now + self.cooldown
+      self.trips += 1
+
+  def GaveUp(self):
+    return self.max_probes > 0 and self.failed_probes >= self.max_probes
+
+  def IsOpen(self, now=None):
+    if now is None:
+      now = time.monotonic()
+    return now < self.open_until
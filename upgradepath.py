@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 import sys
 import re
-import sqlite3
+import bisect
+import functools
 from packaging import version
 
 
@@ -17,29 +18,16 @@ def GetVersion(name):
     return version
 
 
-def GetLatestVersion(operator_name, db_path):
-  con = sqlite3.connect(db_path)
-  cur = con.cursor()
+def GetLatestVersion(operator_name, catalog):
   # Get default channel
-  cmd = "select default_channel from package where name like '%" + operator_name + "%';"
-
-  result = cur.execute(cmd).fetchall()
-  if len(result) == 1:
-    channel = result[0][0]
-    
-    # get version from default cahnnel
-    cmd = "select head_operatorbundle_name from channel where package_name like '" + operator_name + "' and name like '" + channel + "'"
-    result = cur.execute(cmd).fetchall()
-
-    if len(result) == 1:
-      version = GetVersion(result[0][0])
-      return version
-
-
-def GetVersionMatrix(version, matrix):
-  for item in matrix:
-    if GetVersion(item) == version:
-      return matrix[item][1]
+  channel = catalog.GetDefaultChannel(operator_name)
+  if channel is not None:
+    # get version from default channel
+    head_bundle = catalog.GetChannelHead(operator_name, channel)
+    if head_bundle is not None:
+      # The upgrade matrix and the bundle lookups use the version column, which
+      # need not match the version in the bundle name (v2.3.1 vs 2.3.1-0)
+      return catalog.GetBundleVersion(head_bundle) or GetVersion(head_bundle)
 
 
 def SanitizeVersion(version):
@@ -54,13 +42,18 @@ def SanitizeVersion(version):
   if index == 0:
     return version
   else:
-    print(version[:index])
     return version[:index]
 
 
+# Comparable key for a version string, each distinct string is only parsed once
+@functools.lru_cache(maxsize=None)
+def ParseVersion(version_string):
+  return version.parse(SanitizeVersion(version_string))
+
+
 def VersionEval(version1, version2, symbol):
-  v1 = version.parse(SanitizeVersion(version1))
-  v2 = version.parse(SanitizeVersion(version2))
+  v1 = ParseVersion(version1)
+  v2 = ParseVersion(version2)
   if symbol == "<":
     return v1 < v2
   elif symbol == "<=":
@@ -71,29 +64,9 @@ def VersionEval(version1, version2, symbol):
     return v1 >= v2
 
 
-def GetUpgradeMatrix(operator, start_version, latest_version, db_path):
-  con = sqlite3.connect(db_path)
-  cur = con.cursor()
-
-  # Get Operator bundle name
-  cmd = "select default_channel from package where name like '%" + operator + "%';"
-
-  result = cur.execute(cmd).fetchall()
-  if len(result) == 1:
-    channel = result[0][0]
-
-  cmd = "select head_operatorbundle_name from channel where package_name like '" + operator + "' and name like '" + channel + "'"
-  result = cur.execute(cmd).fetchall()
-
-  if len(result) == 1:
-    bundle_name = result[0][0]
-    index = bundle_name.find(".")
-    bundle_name = bundle_name[:index]
-
-
-  cmd = "select name,skiprange,version,replaces from operatorbundle where (name like '%" + \
-      bundle_name + "%' or bundlepath like '%" + bundle_name + "%');"
-  result = cur.execute(cmd)
+def GetUpgradeMatrix(operator, start_version, latest_version, catalog):
+  # Only the default channel, the bundles of the path are looked up there
+  result = catalog.GetPackageBundles(operator, catalog.GetDefaultChannel(operator))
   myDict = {}
 
   bundle = []
@@ -127,30 +100,57 @@ def GetUpgradeMatrix(operator, start_version, latest_version, db_path):
 
 
 
+  # Keep the matrix sorted by version so every skipRange covers a contiguous slice
+  sorted_items = sorted(myDict.items(), key=lambda item: ParseVersion(item[1][0]))
+  sorted_keys = [ParseVersion(v[0]) for k, v in sorted_items]
+  edge_sets = {k: set(v[1]) for k, v in sorted_items}
+
   for entry in bundle:
     skiprange = entry[1]
 
     if skiprange:
-      range = skiprange.split(' ')
-      min = range[0]
-      min_index = re.search(r"\d", min).start()
-      min_oper = min[:min_index]
-      min_version = min[min_index:]
-      
-      max = range[1]
-      max_index = re.search(r"\d", max).start()
-      max_oper = max[:max_index]
-      max_version = max[max_index:]
-
-      for k, v in myDict.items():
-        if VersionEval(v[0], min_version, min_oper):
-          if VersionEval(v[0], max_version, max_oper):
-            if entry[2] not in v[1]:
-              v[1].append(entry[2])
+      for lower, upper in GetSkipRangeSlices(skiprange, sorted_keys):
+        for k, v in sorted_items[lower:upper]:
+          if entry[2] not in edge_sets[k]:
+            edge_sets[k].add(entry[2])
+            v[1].append(entry[2])
 
   return myDict
 
 
+# Turn a skipRange such as ">=4.1.0 <4.3.2" into the [lower, upper) slices of
+# sorted version keys it covers, one per alternative of an OR range
+# (">=1.0.0 <1.2.0 || >=2.0.0 <2.1.0")
+def GetSkipRangeSlices(skiprange, sorted_keys):
+  return [GetSkipRangeSlice(alternative, sorted_keys) for alternative in skiprange.split("||")]
+
+
+# The [lower, upper) slice covered by one AND range. A comparator may be
+# separated from its version by a space, tokens without a version are ignored.
+def GetSkipRangeSlice(skiprange, sorted_keys):
+  lower = 0
+  upper = len(sorted_keys)
+  pending = ""
+  for bound in skiprange.split():
+    match = re.search(r"\d", bound)
+    if match is None:
+      pending = bound
+      continue
+    index = match.start()
+    oper = bound[:index] or pending
+    pending = ""
+    key = ParseVersion(bound[index:])
+    if oper == ">=":
+      lower = max(lower, bisect.bisect_left(sorted_keys, key))
+    elif oper == ">":
+      lower = max(lower, bisect.bisect_right(sorted_keys, key))
+    elif oper == "<":
+      upper = min(upper, bisect.bisect_left(sorted_keys, key))
+    elif oper == "<=":
+      upper = min(upper, bisect.bisect_right(sorted_keys, key))
+  return lower, max(lower, upper)
+
+
 def GetHighestVersionFromMatrix(version_matrix):
   next_version = version_matrix[0]
   for app_version in version_matrix:
@@ -159,54 +159,100 @@ def GetHighestVersionFromMatrix(version_matrix):
   return next_version
 
 
-def GetUpgradePaths(operator, start_version, latest_version, matrix, upgrade_paths, continue_upgrade_path):
-  upgrade_path = continue_upgrade_path
-  upgrade_path_complete = False
-  current_version = start_version
-  while upgrade_path_complete == False:
-    current_version_matrix = GetVersionMatrix(current_version, matrix)
-
-    if current_version_matrix:
-      for v in range(1, len(current_version_matrix)):
-        alternate_path_matrix = upgrade_path.copy()
-        alternate_path_matrix.append(current_version_matrix[v])
-        GetUpgradePaths(operator, current_version_matrix[v], latest_version, matrix, upgrade_paths, alternate_path_matrix)
-
-      upgrade_path.append(current_version_matrix[0])
-      if current_version_matrix[0] == latest_version:
-        upgrade_path_complete = True
-      else:
-        current_version = current_version_matrix[0]
-    
-    else:
-      print("There is no upgrade path for " + operator + " version " + start_version)
-      sys.exit(1)
-
-    # Probably won't need this but just in case there is a weird edge case
-    if VersionEval(SanitizeVersion(current_version), latest_version, ">="):
-        upgrade_path_complete = True
-
-  upgrade_paths.append(upgrade_path)
-
-
-def GetShortestUpgradePath(operator, start_version, db_path):
-
-  latest_version = GetLatestVersion(operator, db_path)
+# Adjacency list of version -> versions it can be upgraded to, built once from the upgrade matrix
+def GetUpgradeGraph(matrix):
+  graph = {}
+  seen = {}
+  for name, entry in matrix.items():
+    edges = graph.setdefault(entry[0], [])
+    edge_set = seen.setdefault(entry[0], set())
+    for next_version in entry[1]:
+      if next_version not in edge_set:
+        edge_set.add(next_version)
+        edges.append(next_version)
+  return graph
+
+
+# Breadth first search over the upgrade graph. Every version is visited once, and all
+# the parents that reach it at the minimal depth are remembered so the minimal paths
+# can be rebuilt without exploring every branch.
+def GetUpgradePathParents(operator, start_version, latest_version, graph):
+  reached_target = {}
+
+  def IsTarget(v):
+    if v not in reached_target:
+      reached_target[v] = v == latest_version or VersionEval(v, latest_version, ">=")
+    return reached_target[v]
+
+  if not graph.get(start_version):
+    print("There is no upgrade path for " + operator + " version " + start_version)
+    sys.exit(1)
+
+  depth = {start_version: 0}
+  parents = {start_version: []}
+  frontier = [start_version]
+  targets = []
+  while frontier and not targets:
+    next_frontier = []
+    for current_version in frontier:
+      for next_version in graph.get(current_version, []):
+        if next_version not in depth:
+          depth[next_version] = depth[current_version] + 1
+          parents[next_version] = [current_version]
+          next_frontier.append(next_version)
+        elif depth[next_version] == depth[current_version] + 1:
+          parents[next_version].append(current_version)
+    targets = [v for v in next_frontier if IsTarget(v)]
+    frontier = next_frontier
+
+  if not targets:
+    print("There is no upgrade path for " + operator + " version " + start_version + " to " + latest_version)
+    sys.exit(1)
+  return targets, parents
+
+
+# Rebuild one minimal path, preferring the first listed edge at every step
+def GetUpgradePath(start_version, target, parents):
+  upgrade_path = [target]
+  while parents[upgrade_path[-1]][0] != start_version:
+    upgrade_path.append(parents[upgrade_path[-1]][0])
+  upgrade_path.reverse()
+  return upgrade_path
+
+
+# All minimal upgrade paths, excluding the start version
+def GetUpgradePaths(operator, start_version, latest_version, matrix):
+  graph = GetUpgradeGraph(matrix)
+  targets, parents = GetUpgradePathParents(operator, start_version, latest_version, graph)
+  memo = {start_version: [[]]}
+
+  def PathsTo(v):
+    if v not in memo:
+      memo[v] = [path + [v] for parent in parents[v] for path in PathsTo(parent)]
+    return memo[v]
+
+  upgrade_paths = []
+  for target in targets:
+    upgrade_paths.extend(PathsTo(target))
+  return upgrade_paths
+
+
+def GetShortestUpgradePath(operator, start_version, catalog):
+
+  latest_version = GetLatestVersion(operator, catalog)
 
   if latest_version != None:
-    if start_version:
-      matrix = GetUpgradeMatrix(operator, start_version, latest_version, db_path)
-      upgrade_paths = []
-      GetUpgradePaths(operator, start_version, latest_version, matrix, upgrade_paths, [])
-
-      shortest_path = upgrade_paths[0]
-      for path in upgrade_paths:
-          if len(path) < len(shortest_path):
-            shortest_path = path
+    if start_version == latest_version:
+      shortest_path = [latest_version]
+    elif start_version:
+      matrix = GetUpgradeMatrix(operator, start_version, latest_version, catalog)
+      graph = GetUpgradeGraph(matrix)
+      targets, parents = GetUpgradePathParents(operator, start_version, latest_version, graph)
+      shortest_path = GetUpgradePath(start_version, targets[0], parents)
     else:
       shortest_path = [latest_version]
 
   else:
     shortest_path = []
   
-  return shortest_path
\ No newline at end of file
+  return shortest_path